@@ -0,0 +1,58 @@
+# admin_keys.py
+"""Hierarchical lookup of attributes by administrative key : the region (gid_1) when it is known, else its country (gid_0).
+
+The attributes of every level are stacked once in a table indexed by (level, key), a hashed pandas MultiIndex. A table
+is then resolved with a single lookup of all its candidate keys in that index : each row takes the attributes of its most
+specific key found, and the rows without any key found are reported.
+
+    index = key_index({"gid_1" : regions, "gid_0" : countries})
+    dose, unresolved = resolve(dose, index, ["geometry"])
+"""
+import numpy as np
+import pandas as pd
+
+# from the most to the least specific
+levels = ["gid_1", "gid_0"]
+
+level_column = "admin_level"
+
+
+def key_index(attributes: dict) -> pd.DataFrame:
+    """Attributes of each level, {level : table with a 'level' key column}, stacked and indexed by (level, key).
+    The tables share the attribute columns, a key repeated within a level is an error.
+    """
+    index = pd.concat([df.rename(columns={level : "key"}).assign(level=level) for level, df in attributes.items()],
+                      ignore_index=True).set_index(["level", "key"])
+
+    duplicated = index.index.duplicated()
+    if duplicated.any():
+        raise ValueError(f"Keys repeated in the index : {index.index[duplicated].unique().tolist()[:10]}")
+
+    return index
+
+
+def resolve(df: pd.DataFrame, index: pd.DataFrame, columns: list = None, keys: list = levels) -> tuple:
+    """Attach the 'columns' of 'index' (all by default) to 'df' from the most specific of its 'keys' found in the index.
+    The level used is in 'admin_level', null for the rows not resolved.
+    Returns the table and the unresolved rows, with their keys.
+    """
+    columns = columns or list(index.columns)
+    n = len(df)
+
+    # every (level, key) candidate of every row, looked up at once
+    candidates = pd.MultiIndex.from_arrays([np.repeat(keys, n), np.concatenate([df[x].to_numpy(dtype=object) for x in keys])])
+    positions = index.index.get_indexer(candidates).reshape(len(keys), n)
+
+    # first level found for each row
+    found = positions >= 0
+    first = found.argmax(axis=0)
+    resolved = found.any(axis=0)
+    position = positions[first, np.arange(n)]
+
+    # aligned on the resolved rows, the others are null
+    attached = index[columns].iloc[position[resolved]].set_axis(df.index[resolved])
+    df = df.drop(columns=columns, errors="ignore").join(attached)
+
+    df[level_column] = pd.Series(np.array(keys, dtype=object)[first], index=df.index).where(resolved)
+
+    return df, df.loc[~resolved, keys]
@@ -1,29 +1,24 @@
-import itertools as iter
-import json
-# import shapely
-from scalenav.plotting import cmap
-import scalenav.oop as snoo
-
-import ibis as ib
-from ibis import _
-
-ib.options.interactive = True
-ib.options.graphviz_repr = True
-
-from parameters import *
+# boundaries.py
+"""Registry of the continent bboxs used to subset the global data sets.
 
-# the spatial extension
-# https://duckdb.org/docs/extensions/spatial/functions
+The bboxs are read lazily from data/bboxs.json, importing this module has no side effect. They are only recomputed from the
+Natural Earth countries when the hash of the shapefile or the 'limit_countries' definition changed since they were last written.
 
+    from boundaries import bboxs  # loaded on first access
+    bboxs = get_bboxs(refresh=True)  # forces the recomputation
+"""
+import os
+import json
+import hashlib
+import itertools as iter
 
+from parameters import map_limits, overture_db_filename
 
-# the h3 extension in duckdb
-# https://github.com/isaacbrodsky/h3-duckdb?tab=readme-ov-file
-conn = snoo.sn_connect(database=overture_db_filename,interactive=True, memory_limit="100GB")
+bboxs_filename = os.path.join(os.path.dirname(__file__), "data", "bboxs.json")
+# hashes of the inputs the bboxs were computed from
+bboxs_meta_filename = os.path.join(os.path.dirname(__file__), "data", "bboxs_meta.json")
 
-### Geo Boundaries
-conn.raw_sql("CREATE OR REPLACE TABLE boundaries as SELECT * FROM ST_Read('/Users/cenv1069/Documents/data/datasets/boundaries/light/ne_110m_admin_0_countries/ne_110m_admin_0_countries.shp');")
-boundaries = conn.table("boundaries")
+ne_countries_file = "/Users/cenv1069/Documents/data/datasets/boundaries/light/ne_110m_admin_0_countries/ne_110m_admin_0_countries.shp"
 
 # making boundaries for continents
 limit_countries = {
@@ -32,40 +27,116 @@ limit_countries = {
         "south america" : ["PER","COL","BRA","CHL",],
         "oceania" : ["AUS","NZL",],
         "asia" : ["KAZ","Turkey","PNG","JPN","TWN"],
-        "africa" : ["TUN","SEN","ZAF","SOM"], 
+        "africa" : ["TUN","SEN","ZAF","SOM"],
 }
 
-country_to_cont = {v:k for k,l in limit_countries.items() for v in l} 
-country_to_cont
-country_values = [x for x in iter.chain(*limit_countries.values())]
-boundaries_selected = (
-    boundaries
-    .filter(_.ADM0_A3.isin(country_values))
-    .mutate(geom=_.geom.buffer(0.5))
-    )
-# getting continents
-continents = boundaries_selected.select("ADMIN","ADM0_A3","SU_A3","geom")
-ib.to_sql(continents)
-continents = continents.alias("b").sql('''
-SELECT 
-    ADM0_A3, 
-    geom::GEOMETRY as geom
-from b;
-''')
-
-### Generating bboxs
-continents_df_ = continents.execute()
-type(continents_df_)
-continents_df_["continent"]=continents_df_["ADM0_A3"].map(country_to_cont)
-continents_df_.set_geometry("geom",inplace=True)
-continents_df_.head()
-continents_df = continents_df_[["continent","geom"]].dissolve(by = "continent").reset_index()
-
-continents_df["bounds"] = continents_df["geom"].apply(lambda x : list(x.bounds))
-bboxs = {x[0]:y[0] for x,y in continents_df[["continent","bounds"]].apply(zip,axis=1)}
-bboxs["global"] = map_limits
-
-# bboxs
-with open("notebooks/data/bboxs.json", "w") as out_file:
-    json.dump(bboxs, out_file)
+# buffer around the limit countries, in degrees
+buffer_deg = 0.5
+
+_bboxs = None
+
+
+def file_hash(path: str) -> str:
+    """sha256 of a shapefile, including its attribute table."""
+    sha = hashlib.sha256()
+    for file in [path, path.replace(".shp", ".dbf")]:
+        with open(file, "rb") as fh:
+            chunk = fh.read(1 << 20)
+            while chunk:
+                sha.update(chunk)
+                chunk = fh.read(1 << 20)
+    return sha.hexdigest()
+
+
+def definition_hash() -> str:
+    """Hash of the continents definition."""
+    return hashlib.sha256(json.dumps([limit_countries, buffer_deg, map_limits], sort_keys=True).encode()).hexdigest()
+
+
+def current_meta() -> dict:
+    """Hashes of the current inputs, the source hash is None when the shapefile is not available."""
+    return {
+        "source_hash" : file_hash(ne_countries_file) if os.path.exists(ne_countries_file) else None,
+        "definition_hash" : definition_hash(),
+    }
+
+
+def is_stale() -> bool:
+    """Whether the saved bboxs need to be recomputed. Without the source shapefile, the saved bboxs are used as they are."""
+    if not os.path.exists(bboxs_filename):
+        return True
+
+    meta = current_meta()
+    if meta["source_hash"] is None:
+        return False
+
+    if not os.path.exists(bboxs_meta_filename):
+        return True
+
+    with open(bboxs_meta_filename, "r") as meta_fh:
+        return json.load(meta_fh) != meta
+
+
+def compute_bboxs() -> dict:
+    """Compute the bbox of each continent from the buffered extent of its limit countries."""
+    # only loaded when recomputing, with an in memory data base
+    # boundary_providers imports this module, it is only imported here
+    import scalenav.oop as snoo
+    import boundary_providers as bp
+
+    conn = snoo.sn_connect(interactive=False)
+
+    country_to_cont = {v:k for k,l in limit_countries.items() for v in l}
+    country_values = [x for x in iter.chain(*limit_countries.values())]
+
+    ### Natural Earth countries, read from the converted provider file instead of the shapefile
+    countries = bp.read_provider(conn, "naturalearth", countries=country_values)
+    continents = countries.alias("countries").sql(f"""
+    SELECT gid_0, ST_XMin(geom) as xmin, ST_YMin(geom) as ymin, ST_XMax(geom) as xmax, ST_YMax(geom) as ymax
+    FROM (
+        SELECT gid_0, ST_Buffer(geometry::GEOMETRY, {buffer_deg}) as geom
+        FROM countries
+    );
+    """).execute()
+
+    ### Generating bboxs, the extent of the dissolved countries is the extent of their extents
+    continents["continent"] = continents["gid_0"].map(country_to_cont)
+    continents = continents.groupby("continent").agg({"xmin" : "min", "ymin" : "min", "xmax" : "max", "ymax" : "max"})
+
+    bboxs = {cont : row.tolist() for cont, row in continents[["xmin","ymin","xmax","ymax"]].iterrows()}
+    bboxs["global"] = map_limits
+
+    return bboxs
+
+
+def get_bboxs(refresh: bool = False) -> dict:
+    """Continent bboxs as {name : [xmin,ymin,xmax,ymax]}, recomputed and saved only if stale or when 'refresh' is set."""
+    global _bboxs
+
+    if _bboxs is not None and not refresh:
+        return _bboxs
+
+    if refresh or is_stale():
+        _bboxs = compute_bboxs()
+
+        with open(bboxs_filename, "w") as out_file:
+            json.dump(_bboxs, out_file)
+        with open(bboxs_meta_filename, "w") as meta_fh:
+            json.dump(current_meta(), meta_fh)
+
+    else:
+        with open(bboxs_filename, "r") as in_file:
+            _bboxs = json.load(in_file)
+
+    return _bboxs
+
+
+def __getattr__(name):
+    # lazy module attribute, 'from boundaries import bboxs' reads the registry on first access only
+    if name == "bboxs":
+        return get_bboxs()
+    raise AttributeError(f"module '{__name__}' has no attribute '{name}'")
+
 
+if __name__ == "__main__":
+    print(get_bboxs(refresh=True))
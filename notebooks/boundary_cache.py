@@ -0,0 +1,110 @@
+# boundary_cache.py
+"""GeoParquet cache of the ADM1 regions of DOSE : GADM 3.6 and the custom regions of the DOSE replication files.
+
+The two shapefiles are merged once, in duckdb, into a single GeoParquet file with :
+    - the ids and names of the regions (gid_0, name_0, gid_1, name_1)
+    - the bbox of each region (xmin, ymin, xmax, ymax)
+    - one geometry column per level of simplification, see 'levels'
+The loaders only read the geometry column of the level requested, use the coarsest level acceptable for the task :
+the ids for the joins on gid_1, '1km' for areas and maps at country scale, '100m' for centroids and point in polygon.
+
+    boundaries = read_boundaries(conn, level="1km")
+"""
+import os
+
+import ibis as ib
+
+gadm_path = '../datasets/DOSE/V2/DOSE_replication_files/DOSE_replication_files/Data/spatial data/'
+gadm_file = f"{gadm_path}gadm36_levels_shp/gadm36_1.shp"
+# has to be downloaded from https://gadm.org/download_world36.html; follow instructions in readme
+custom_file = f"{gadm_path}all_non_GADM_regions.shp"
+
+#list of GADM countries whose data is not needed because we provide it with the custom file
+unneeded_list = ["KAZ","MKD","NPL","PHL","LKA"]
+
+boundary_cache_file = "../datasets/DOSE/V2/gadm36_1_custom_merged_levels.parquet"
+
+# simplification tolerance of each geometry column, in degrees : ~100 m and ~1 km at the equator
+levels = {
+    "full" : 0,
+    "100m" : 0.001,
+    "1km" : 0.01,
+}
+
+id_columns = ["gid_0", "name_0", "gid_1", "name_1"]
+bbox_columns = ["xmin", "ymin", "xmax", "ymax"]
+
+
+def id_aliases() -> str:
+    """The id columns aliased in lower case : duckdb matches the upper case columns of the shapefiles but keeps their names."""
+    return ", ".join([f"{x} as {x}" for x in id_columns])
+
+
+def geometry_column(level: str) -> str:
+    if level not in levels:
+        raise ValueError(f"Unknown level '{level}', one of {list(levels.keys())}.")
+
+    return "geometry" if level == "full" else f"geometry_{level}"
+
+
+def build_boundaries(conn: ib.backends.duckdb.Backend, out_file: str = boundary_cache_file) -> str:
+    """Merge GADM, without the countries of 'unneeded_list', and the custom regions into the GeoParquet cache."""
+    ids = ", ".join(id_columns)
+    aliases = id_aliases()
+    simplified = ", ".join([f"ST_SimplifyPreserveTopology(geom, {tolerance}) as {geometry_column(level)}"
+                            for level, tolerance in levels.items() if level != "full"])
+
+    os.makedirs(os.path.dirname(out_file), exist_ok=True)
+
+    # the columns are matched by name, the shapefiles have upper case names
+    conn.raw_sql(f"""
+    CREATE OR REPLACE TEMP TABLE boundaries_merged AS
+        SELECT {aliases}, geom FROM st_read('{gadm_file}') WHERE gid_0 NOT IN ({",".join([f"'{x}'" for x in unneeded_list])})
+        UNION ALL BY NAME
+        SELECT {aliases}, geom FROM st_read('{custom_file}');
+
+    COPY (
+        SELECT {ids},
+            ST_XMin(geom) as xmin, ST_YMin(geom) as ymin, ST_XMax(geom) as xmax, ST_YMax(geom) as ymax,
+            geom as geometry,
+            {simplified}
+        FROM boundaries_merged
+        ORDER BY gid_0, gid_1
+    ) TO '{out_file}' (FORMAT PARQUET);
+
+    DROP TABLE boundaries_merged;
+    """)
+
+    return out_file
+
+
+def check_boundaries(conn: ib.backends.duckdb.Backend, cache_file: str = boundary_cache_file, refresh: bool = False):
+    """Build the cache on first use or when 'refresh' is set."""
+    if refresh or not os.path.exists(cache_file):
+        print(f"Caching '{gadm_file}' and '{custom_file}' to '{cache_file}'.")
+        build_boundaries(conn, cache_file)
+
+
+def read_boundaries(conn: ib.backends.duckdb.Backend, level: str = None, countries: list = None, cache_file: str = boundary_cache_file) -> ib.Table:
+    """ADM1 regions with the geometry of 'level' as 'geometry', only the ids and bbox without level.
+    Only the columns of the level are read from the file, 'countries' filters on gid_0.
+    """
+    check_boundaries(conn, cache_file)
+
+    # aliased, a cache written with the upper case names of the shapefiles is read the same
+    columns = [id_aliases(), *bbox_columns]
+    if level is not None:
+        columns.append(f"{geometry_column(level)} as geometry")
+
+    country_filter = ""
+    if countries is not None:
+        country_filter = "WHERE gid_0 IN ({})".format(",".join([f"'{x}'" for x in countries]))
+
+    return conn.sql(f"""SELECT {", ".join(columns)} FROM read_parquet('{cache_file}') {country_filter};""")
+
+
+if __name__ == "__main__":
+    import scalenav.oop as snoo
+
+    conn = snoo.sn_connect(interactive=False)
+    build_boundaries(conn)
@@ -0,0 +1,204 @@
+# boundary_providers.py
+"""Boundary sets behind a common schema : gid_0, name_0, gid_1, name_1, geometry.
+
+Each provider of 'providers' is converted once from its source file (shapefile, GeoPackage, ...) into a GeoParquet file
+under 'provider_path', with the bbox of each unit. The rows are sorted along a Hilbert curve of the bbox centres so each
+capped row group covers a compact area, and a sidecar index of the row group bboxs is written next to the file (see
+overture_layout.py). The conversion is redone only when the source file is newer than the converted one, switching
+boundary sets then reads a few parquet row groups instead of re-parsing the source.
+
+    regions = read_provider(conn, "geoboundaries", countries=["FRA","ITA"])
+    regions = read_provider(conn, "gadm41", bbox=[5,45,10,48])
+"""
+import os
+import json
+
+import pandas as pd
+import pyarrow.parquet as pq
+import ibis as ib
+
+import boundary_cache as bc
+import overture_layout as ol
+from boundaries import ne_countries_file
+
+provider_path = "../datasets/boundaries/providers/"
+
+# units per row group of the converted files
+row_group_size = 256
+
+# source file and layer, expressions of the common columns on the source columns, and level of the units
+providers = {
+    # GADM 3.6 and the custom DOSE regions, from the boundary cache
+    "dose" : {
+        "file" : bc.boundary_cache_file,
+        "layer" : None,
+        "columns" : {"gid_0" : "gid_0", "name_0" : "name_0", "gid_1" : "gid_1", "name_1" : "name_1", "geometry" : "geometry"},
+        "level" : "adm1",
+    },
+    # https://gadm.org/download_world.html, the 'levels' GeoPackage next to the GADM 3.6 shapefiles, one layer per level
+    "gadm41" : {
+        "file" : f"{bc.gadm_path}gadm_410-levels.gpkg",
+        "layer" : "ADM_1",
+        "columns" : {"gid_0" : "GID_0", "name_0" : "COUNTRY", "gid_1" : "GID_1", "name_1" : "NAME_1", "geometry" : "geom"},
+        "level" : "adm1",
+    },
+    # https://www.geoboundaries.org/globalDownloads.html, CGAZ has no country names
+    "geoboundaries" : {
+        "file" : "../datasets/boundaries/GeoBoundaries/geoBoundariesCGAZ_ADM1.gpkg",
+        "layer" : None,
+        "columns" : {"gid_0" : "shapeGroup", "name_0" : "shapeGroup", "gid_1" : "shapeID", "name_1" : "shapeName", "geometry" : "geom"},
+        "level" : "adm1",
+    },
+    # countries only
+    "naturalearth" : {
+        "file" : ne_countries_file,
+        "layer" : None,
+        "columns" : {"gid_0" : "ADM0_A3", "name_0" : "NAME", "gid_1" : "NULL::VARCHAR", "name_1" : "NULL::VARCHAR", "geometry" : "geom"},
+        "level" : "adm0",
+    },
+}
+
+id_columns = bc.id_columns
+bbox_columns = bc.bbox_columns
+
+# GeoParquet metadata of the converted files, WKB geometry in lon/lat
+geo_metadata = {
+    "version" : "1.1.0",
+    "primary_column" : "geometry",
+    "columns" : {"geometry" : {"encoding" : "WKB", "geometry_types" : []}},
+}
+
+
+def get_provider(name: str) -> dict:
+    if name not in providers:
+        raise ValueError(f"Unknown boundary provider '{name}', one of {list(providers.keys())}.")
+
+    return providers[name]
+
+
+def provider_file(name: str, path: str = provider_path) -> str:
+    """Converted GeoParquet file of a provider."""
+    return os.path.join(path, f"{name}.parquet")
+
+
+def source_query(name: str) -> str:
+    """Rows of the source file of a provider in the common schema, geometry as 'geom'."""
+    provider = get_provider(name)
+    columns = provider["columns"]
+
+    if provider["file"].endswith(".parquet"):
+        source = f"read_parquet('{provider['file']}')"
+    elif provider["layer"] is not None:
+        source = f"st_read('{provider['file']}', layer='{provider['layer']}')"
+    else:
+        source = f"st_read('{provider['file']}')"
+
+    return f"""SELECT {", ".join([f"{columns[x]} as {x}" for x in id_columns])}, {columns["geometry"]} as geom FROM {source}"""
+
+
+def convert(conn: ib.backends.duckdb.Backend, name: str, path: str = provider_path) -> str:
+    """Convert the source of a provider to the sorted GeoParquet file with its row group index."""
+    if name == "dose":
+        bc.check_boundaries(conn)
+
+    out_file = provider_file(name, path)
+    os.makedirs(os.path.dirname(out_file), exist_ok=True)
+
+    # Hilbert curve of the bbox centres over the world extent
+    hilbert = "ST_Hilbert((xmin+xmax)/2, (ymin+ymax)/2, ST_Extent(ST_MakeEnvelope(-180, -90, 180, 90)))"
+
+    # the source is parsed a single time
+    table = conn.sql(f"""
+    SELECT {", ".join([*id_columns, *bbox_columns])}, ST_AsWKB(geom)::BLOB as geometry
+    FROM (
+        SELECT *, ST_XMin(geom) as xmin, ST_YMin(geom) as ymin, ST_XMax(geom) as xmax, ST_YMax(geom) as ymax
+        FROM ({source_query(name)})
+        WHERE geom IS NOT NULL
+    )
+    ORDER BY {hilbert};
+    """).to_pyarrow()
+
+    # written with pyarrow, duckdb does not write row groups smaller than 2048 rows
+    table = table.replace_schema_metadata({"geo" : json.dumps(geo_metadata)})
+    tmp_file = f"{out_file}.tmp"
+    pq.write_table(table, tmp_file, row_group_size=row_group_size)
+    os.replace(tmp_file, out_file)
+
+    write_index(conn, out_file)
+
+    return out_file
+
+
+def write_index(conn: ib.backends.duckdb.Backend, filename: str) -> pd.DataFrame:
+    """Row group index of a converted file : extent of the bboxs of its units."""
+    index = conn.sql(f"""
+    SELECT
+        row_group_id as row_group,
+        any_value(row_group_num_rows) as num_rows,
+        min(CASE WHEN path_in_schema='xmin' THEN stats_min_value END)::DOUBLE as xmin,
+        max(CASE WHEN path_in_schema='xmax' THEN stats_max_value END)::DOUBLE as xmax,
+        min(CASE WHEN path_in_schema='ymin' THEN stats_min_value END)::DOUBLE as ymin,
+        max(CASE WHEN path_in_schema='ymax' THEN stats_max_value END)::DOUBLE as ymax
+    FROM parquet_metadata('{filename}')
+    GROUP BY row_group_id
+    ORDER BY row_group_id;
+    """).execute()
+
+    index.to_parquet(ol.index_filename(filename), index=False)
+
+    return index
+
+
+def is_stale(name: str, path: str = provider_path) -> bool:
+    """Whether the converted file of a provider is missing or older than its source. Without the source, the converted file is used as it is."""
+    out_file = provider_file(name, path)
+    if not (os.path.exists(out_file) and os.path.exists(ol.index_filename(out_file))):
+        return True
+
+    source_file = get_provider(name)["file"]
+    if not os.path.exists(source_file):
+        return False
+
+    return os.path.getmtime(source_file) > os.path.getmtime(out_file)
+
+
+def check_provider(conn: ib.backends.duckdb.Backend, name: str, path: str = provider_path, refresh: bool = False) -> str:
+    """Convert the provider on first use, when its source changed, or when 'refresh' is set."""
+    if refresh or is_stale(name, path):
+        print(f"Converting '{get_provider(name)['file']}' to '{provider_file(name, path)}'.")
+        convert(conn, name, path)
+
+    return provider_file(name, path)
+
+
+def read_provider(conn: ib.backends.duckdb.Backend, name: str, countries: list = None, bbox: list = None, path: str = provider_path) -> ib.Table:
+    """Units of a provider in the common schema, with their bbox.
+    'countries' filters on gid_0. With a 'bbox' ([xmin,ymin,xmax,ymax]), only the row groups intersecting it are read
+    and the units whose bbox intersects it are kept.
+    """
+    filename = check_provider(conn, name, path)
+
+    filters = []
+    if countries is not None:
+        filters.append("gid_0 IN ({})".format(",".join([f"'{x}'" for x in countries])))
+
+    if bbox is None:
+        source, geometry = f"read_parquet('{filename}')", "geometry"
+    else:
+        # the geometry comes back from Arrow as WKB
+        ol.read_row_groups(conn, filename, ol.row_groups_bbox(filename, bbox), f"provider_{name}_bbox")
+        source, geometry = f"provider_{name}_bbox", "ST_GeomFromWKB(geometry)"
+        filters.append(f"xmax >= {bbox[0]} AND xmin <= {bbox[2]} AND ymax >= {bbox[1]} AND ymin <= {bbox[3]}")
+
+    where = f"WHERE {' AND '.join(filters)}" if filters else ""
+
+    return conn.sql(f"""SELECT {", ".join([*id_columns, *bbox_columns])}, {geometry} as geometry FROM {source} {where};""")
+
+
+if __name__ == "__main__":
+    import sys
+    import scalenav.oop as snoo
+
+    conn = snoo.sn_connect(interactive=False)
+    for name in sys.argv[1:] or providers.keys():
+        check_provider(conn, name, refresh=True)
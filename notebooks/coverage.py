@@ -0,0 +1,88 @@
+# coverage.py
+"""Coverage of the ADM1 regions of the reference boundaries in DOSE.
+
+A single query compares the regions of the boundaries with the regions present in DOSE, for one, several or all the years
+of the DOSE table. Each (year, country) row has the expected, present and missing region counts, the representation
+fraction and the list of missing regions. The country and region lists of the gap filling are then read from this one table.
+
+    coverage_df = coverage(boundaries, dose, years=[2015]).execute()
+"""
+import pandas as pd
+import ibis as ib
+from ibis import _
+
+
+def coverage(boundaries: ib.Table, dose: ib.Table, years: list = None) -> ib.Table:
+    """Coverage of the regions of 'boundaries' (gid_0, gid_1) in 'dose' (year, gid_0, gid_1) for 'years', all the years of 'dose' by default.
+
+    Columns :
+        - expected : regions of the country in the boundaries
+        - present / missing : regions of the boundaries found / not found in DOSE
+        - dose_count : rows of the country in DOSE, the representation fraction 'repr_frac' is dose_count/expected
+        - missing_regions : gid_1 of the missing regions
+    """
+    if years is not None:
+        dose = dose.filter(dose.year.isin(years))
+
+    dose = dose.select("year", "gid_0", "gid_1")
+    dose_years = dose.select("year").distinct()
+    regions = boundaries.select("gid_0", "gid_1").distinct()
+
+    expected = regions.group_by("gid_0").agg(expected=_.count())
+    dose_count = dose.group_by("year", "gid_0").agg(dose_count=_.count())
+
+    # every region of the boundaries for every year, without the ones in DOSE
+    missing = (regions
+               .cross_join(dose_years)
+               .anti_join(dose, ["year", "gid_1"])
+               .group_by("year", "gid_0")
+               .agg(missing=_.count(), missing_regions=_.gid_1.collect()))
+
+    return (expected
+            .cross_join(dose_years)
+            .left_join(dose_count, ["year", "gid_0"])
+            .left_join(missing, ["year", "gid_0"])
+            .mutate(dose_count=_.dose_count.fill_null(0), missing=_.missing.fill_null(0))
+            .mutate(present=_.expected - _.missing, repr_frac=_.dose_count / _.expected)
+            .select("year", "gid_0", "expected", "present", "missing", "dose_count", "repr_frac", "missing_regions")
+            .order_by("year", "gid_0"))
+
+
+def select_countries(coverage_df: pd.DataFrame, mask: pd.Series, by_year: bool = False):
+    """Countries of the rows selected by 'mask', as a list or, 'by_year', as a (year, gid_0) table."""
+    if by_year:
+        return coverage_df.loc[mask, ["year", "gid_0"]].reset_index(drop=True)
+
+    return coverage_df.loc[mask, "gid_0"].unique().tolist()
+
+
+def dose_countries(dose: ib.Table, years: list = None) -> list:
+    """Countries with at least one row in DOSE for 'years', including the ones absent from the boundaries."""
+    if years is not None:
+        dose = dose.filter(dose.year.isin(years))
+
+    return sorted(dose.select("gid_0").distinct().execute().gid_0.dropna().tolist())
+
+
+def unmatched_countries(coverage_df: pd.DataFrame, countries: list) -> list:
+    """Countries of DOSE without any region in the boundaries, they are not in the coverage table."""
+    return sorted(set(countries) - set(coverage_df.gid_0))
+
+
+def incomplete_countries(coverage_df: pd.DataFrame, by_year: bool = False):
+    """Countries in DOSE with fewer rows than regions in the boundaries."""
+    return select_countries(coverage_df, (coverage_df.dose_count > 0) & (coverage_df.repr_frac < 1), by_year)
+
+
+def missing_countries(coverage_df: pd.DataFrame, by_year: bool = False):
+    """Countries of the boundaries absent from DOSE."""
+    return select_countries(coverage_df, coverage_df.dose_count == 0, by_year)
+
+
+def missing_regions(coverage_df: pd.DataFrame) -> pd.DataFrame:
+    """Missing regions as a (year, gid_0, gid_1) table."""
+    return (coverage_df[["year", "gid_0", "missing_regions"]]
+            .explode("missing_regions")
+            .dropna(subset="missing_regions")
+            .rename(columns={"missing_regions" : "gid_1"})
+            .reset_index(drop=True))
@@ -0,0 +1,49 @@
+# dissolve.py
+"""Dissolve of polygons by group in a process pool, e.g. the ADM1 regions into countries.
+
+The groups with a single member keep their geometry, without union. The unions of the other groups run in parallel, one
+task per group, the groups with the most vertices submitted first so that the largest countries do not end the run alone.
+The geometries go to the workers as WKB. The pool uses the default start method of the platform, a spawned worker
+re-imports the calling script : call it from a function under an `if __name__ == "__main__":` guard, as missing_countries_geo.py.
+
+    countries = dissolve(regions, "gid_0")
+"""
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+import geopandas as gpd
+import shapely
+
+# below this number of groups to union, the unions run in the current process
+min_parallel = 8
+
+
+def union_wkb(wkbs: list) -> bytes:
+    """Union of the geometries, runs in a worker process."""
+    return shapely.union_all(shapely.from_wkb(wkbs)).wkb
+
+
+def dissolve(gdf: gpd.GeoDataFrame, by: str, n_workers: int = None) -> gpd.GeoDataFrame:
+    """Union of the geometries of 'gdf' by 'by', as a (by, geometry) table in the crs of 'gdf'."""
+    geometry = gdf.geometry.name
+    counts = gdf[by].value_counts()
+
+    single = gdf[gdf[by].isin(counts.index[counts == 1])][[by, geometry]]
+
+    multiple = gdf[gdf[by].isin(counts.index[counts > 1])]
+    sizes = pd.Series(shapely.get_num_coordinates(multiple.geometry.values), index=multiple.index).groupby(multiple[by]).sum()
+    groups = multiple.geometry.to_wkb().groupby(multiple[by]).agg(list)
+    # the largest groups first
+    groups = groups[sizes.sort_values(ascending=False).index]
+
+    if len(groups) < min_parallel or n_workers == 1:
+        unions = [union_wkb(x) for x in groups]
+    else:
+        n_workers = n_workers or os.cpu_count()
+        with ProcessPoolExecutor(max_workers=n_workers) as pool:
+            unions = list(pool.map(union_wkb, groups))
+
+    dissolved = gpd.GeoDataFrame({by : groups.index, geometry : shapely.from_wkb(unions)}, geometry=geometry, crs=gdf.crs)
+
+    return pd.concat([single, dissolved], ignore_index=True).sort_values(by).reset_index(drop=True)
@@ -0,0 +1,73 @@
+# dose_wdi.py
+"""The combined dose-wdi table passed from missing_countries.py to missing_countries_geo.py.
+
+The table is converted once to Arrow with a fixed schema, and written as parquet partitioned by year, so the geo stage
+reads it back with the same types. When both stages run in the same process, the Arrow table is published here and the
+geo stage registers it in duckdb as a view, without writing nor reading any file.
+
+    dose_light = read_dose_wdi(conn, path, years=[2015])
+"""
+import os
+
+import pandas as pd
+import pyarrow as pa
+import ibis as ib
+
+dose_wdi_schema = pa.schema([
+    ("country", pa.string()),
+    ("gid_0", pa.string()),
+    ("gid_1", pa.string()),
+    ("year", pa.int32()),
+    ("grp_usd_2015", pa.float64()),
+    ("services_usd_2015", pa.float64()),
+    ("manufacturing_usd_2015", pa.float64()),
+    ("agriculture_usd_2015", pa.float64()),
+])
+
+# tables of the current process, by name
+published = {}
+
+
+def to_arrow(df: pd.DataFrame) -> pa.Table:
+    """The combined table as Arrow, with the columns and types of 'dose_wdi_schema'."""
+    return pa.Table.from_pandas(df[dose_wdi_schema.names], schema=dose_wdi_schema, preserve_index=False)
+
+
+def publish(table: pa.Table, name: str = "dose_light_combined"):
+    """Make the table available to the next stages of the process."""
+    published[name] = table
+
+
+def register(conn: ib.backends.duckdb.Backend, table: pa.Table, name: str = "dose_light_combined") -> ib.Table:
+    """View on the Arrow table in duckdb, the data is not copied."""
+    conn.con.register(name, table)
+
+    return conn.table(name)
+
+
+def write_dose_wdi(conn: ib.backends.duckdb.Backend, table: pa.Table, path: str, name: str = "dose_light_combined") -> str:
+    """Write the table as parquet partitioned by year under 'path'."""
+    register(conn, table, name)
+    conn.raw_sql(f"""COPY {name} TO '{path}' (FORMAT PARQUET, PARTITION_BY (year), OVERWRITE_OR_IGNORE);""")
+
+    return path
+
+
+def read_dose_wdi(conn: ib.backends.duckdb.Backend, path: str, years: list = None, name: str = "dose_light_combined") -> ib.Table:
+    """The combined table, from the current process when published, otherwise from the parquet files under 'path'.
+    Only the partitions of 'years' are read, all by default.
+    """
+    if name in published:
+        print(f"Using the '{name}' table of the current process.")
+        dose_wdi = register(conn, published[name], name)
+    elif os.path.exists(path):
+        dose_wdi = conn.sql(f"""
+        SELECT * FROM read_parquet('{path}/**/*.parquet', hive_partitioning=true, hive_types={{'year' : INTEGER}});
+        """)
+    else:
+        raise FileNotFoundError(f"No dose-wdi data set at '{path}', run missing_countries.py first.")
+
+    if years is not None:
+        dose_wdi = dose_wdi.filter(dose_wdi.year.isin(list(years)))
+
+    return dose_wdi
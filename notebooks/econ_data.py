@@ -0,0 +1,225 @@
+# econ_data.py
+"""Typed loaders of the economic data sets used to fill the DOSE gaps.
+
+DOSE is distributed as a single csv where the missing values are written '#N/A', which made duckdb read every column as strings.
+The csv is converted once, with a declared schema and '#N/A' read as null, into a parquet cache partitioned by year.
+Each run then only reads the year and the columns it needs, already typed.
+
+    dose = read_dose(conn, years=[2015])
+
+WDI is distributed wide, one row per country and indicator with a column per year. It is converted once to a long
+(country_code, year, indicator_code, value) parquet store partitioned by indicator, so that a selection of indicators
+only reads their partitions. 'wdi_matrix' returns the country x indicator table of a few indicators and years.
+
+    wdi = wdi_matrix(conn, indicators=["NY.GDP.MKTP.KD"], years=[2015])
+"""
+import os
+
+import ibis as ib
+
+dose_file = "../datasets/DOSE/V2.10/DOSE_V2.10.csv"
+dose_cache_path = "../datasets/DOSE/V2.10/processed/dose"
+
+# values standing for a missing value in the csv
+dose_nulls = ["#N/A", "NA", ""]
+
+# schema of DOSE V2.10, in the order of the csv columns
+dose_schema = {
+    "country" : "VARCHAR",
+    "region" : "VARCHAR",
+    "GID_0" : "VARCHAR",
+    "GID_1" : "VARCHAR",
+    "year" : "INTEGER",
+    "grp_lcu" : "DOUBLE",
+    "pop" : "DOUBLE",
+    "grp_pc_lcu" : "DOUBLE",
+    "ag_grp_pc_lcu" : "DOUBLE",
+    "man_grp_pc_lcu" : "DOUBLE",
+    "serv_grp_pc_lcu" : "DOUBLE",
+    "grp_pc_usd" : "DOUBLE",
+    "ag_grp_pc_usd" : "DOUBLE",
+    "man_grp_pc_usd" : "DOUBLE",
+    "serv_grp_pc_usd" : "DOUBLE",
+    "grp_pc_lcu_2015" : "DOUBLE",
+    "ag_grp_pc_lcu_2015" : "DOUBLE",
+    "man_grp_pc_lcu_2015" : "DOUBLE",
+    "serv_grp_pc_lcu_2015" : "DOUBLE",
+    "grp_pc_usd_2015" : "DOUBLE",
+    "ag_grp_pc_usd_2015" : "DOUBLE",
+    "man_grp_pc_usd_2015" : "DOUBLE",
+    "serv_grp_pc_usd_2015" : "DOUBLE",
+    "grp_pc_lcu2015_usd" : "DOUBLE",
+    "ag_grp_pc_lcu2015_usd" : "DOUBLE",
+    "man_grp_pc_lcu2015_usd" : "DOUBLE",
+    "serv_grp_pc_lcu2015_usd" : "DOUBLE",
+    "cpi_2015" : "DOUBLE",
+    "deflator_2015" : "DOUBLE",
+    "fx" : "DOUBLE",
+    "PPP" : "DOUBLE",
+    "StructChange" : "VARCHAR",
+    "version" : "VARCHAR",
+    "T_a" : "DOUBLE",
+    "P_a" : "DOUBLE",
+}
+
+
+def cache_dose(conn: ib.backends.duckdb.Backend, source: str = dose_file, out_path: str = dose_cache_path) -> str:
+    """Convert the DOSE csv to parquet partitioned by year, with the declared schema. Any value not castable to its type fails the conversion."""
+    columns = ", ".join([f"'{name}' : '{dtype}'" for name, dtype in dose_schema.items()])
+    nulls = ", ".join([f"'{x}'" for x in dose_nulls])
+
+    os.makedirs(os.path.dirname(out_path), exist_ok=True)
+
+    conn.raw_sql(f"""
+    COPY (SELECT * FROM read_csv('{source}', header=true, columns={{{columns}}}, nullstr=[{nulls}]))
+        TO '{out_path}' (FORMAT PARQUET, PARTITION_BY (year), OVERWRITE_OR_IGNORE);
+    """)
+
+    return out_path
+
+
+def read_dose(conn: ib.backends.duckdb.Backend, years: list = None, columns: list = None, refresh: bool = False, cache_path: str = dose_cache_path) -> ib.Table:
+    """DOSE from the parquet cache, written from the csv on first use or when 'refresh' is set.
+    Only the partitions of 'years' and the listed 'columns' are read, all by default.
+    """
+    if refresh or not os.path.exists(cache_path):
+        print(f"Caching '{dose_file}' to '{cache_path}'.")
+        cache_dose(conn, out_path=cache_path)
+
+    columns = columns or list(dose_schema.keys())
+    year_filter = f"WHERE year IN ({','.join([str(int(x)) for x in years])})" if years is not None else ""
+
+    return conn.sql(f"""
+    SELECT {", ".join([f'"{x}"' for x in columns])}
+    FROM read_parquet('{cache_path}/**/*.parquet', hive_partitioning=true, hive_types={{'year' : INTEGER}})
+    {year_filter};
+    """)
+
+
+wdi_file = "../datasets/WDI_CSV_2024_06_28/WDICSV.csv"
+wdi_store_path = "../datasets/WDI_CSV_2024_06_28/processed/wdi"
+
+
+def wdi_indicators_filename(store_path: str = wdi_store_path) -> str:
+    """Sidecar table of the indicator codes and names of a WDI store."""
+    return f"{store_path}_indicators.parquet"
+
+
+def wdi_countries_filename(store_path: str = wdi_store_path) -> str:
+    """Sidecar table of the country codes and names of a WDI store."""
+    return f"{store_path}_countries.parquet"
+
+
+def cache_wdi(conn: ib.backends.duckdb.Backend, source: str = wdi_file, out_path: str = wdi_store_path) -> str:
+    """Convert the wide WDI csv to the long parquet store partitioned by indicator code, empty values are dropped.
+    The country and indicator names are kept apart in small sidecar tables.
+    """
+    os.makedirs(os.path.dirname(out_path), exist_ok=True)
+
+    conn.raw_sql(f"""
+    CREATE OR REPLACE TEMP TABLE wdi_wide AS
+        SELECT * FROM read_csv('{source}', header=true, all_varchar=true);
+
+    COPY (
+        SELECT "Country Code" as country_code, year::INTEGER as year, "Indicator Code" as indicator_code, TRY_CAST(value AS DOUBLE) as value
+        FROM (UNPIVOT (SELECT "Country Code", "Indicator Code", COLUMNS('^[0-9]{{4}}$') FROM wdi_wide)
+              ON COLUMNS('^[0-9]{{4}}$') INTO NAME year VALUE value)
+        WHERE TRY_CAST(value AS DOUBLE) IS NOT NULL
+        ORDER BY country_code, year
+    ) TO '{out_path}' (FORMAT PARQUET, PARTITION_BY (indicator_code), OVERWRITE_OR_IGNORE);
+
+    COPY (SELECT DISTINCT "Indicator Code" as indicator_code, "Indicator Name" as indicator_name FROM wdi_wide ORDER BY indicator_code)
+        TO '{wdi_indicators_filename(out_path)}' (FORMAT PARQUET);
+
+    COPY (SELECT DISTINCT "Country Code" as country_code, "Country Name" as country_name FROM wdi_wide ORDER BY country_code)
+        TO '{wdi_countries_filename(out_path)}' (FORMAT PARQUET);
+
+    DROP TABLE wdi_wide;
+    """)
+
+    return out_path
+
+
+def check_wdi(conn: ib.backends.duckdb.Backend, store_path: str = wdi_store_path, refresh: bool = False, source: str = wdi_file):
+    """Write the WDI store from 'source' on first use or when 'refresh' is set.
+    The default paths are relative to notebooks/, callers running elsewhere pass their own 'store_path' and 'source'.
+    """
+    if refresh or not os.path.exists(wdi_indicators_filename(store_path)):
+        print(f"Caching '{source}' to '{store_path}'.")
+        cache_wdi(conn, source=source, out_path=store_path)
+
+
+def sql_list(values) -> str:
+    return ",".join([f"'{x}'" for x in values])
+
+
+def wdi_filter(indicators: list = None, years: list = None, countries: list = None) -> str:
+    """WHERE clause on the long store, the filter on the indicators prunes the partitions."""
+    filters = []
+    if indicators is not None:
+        filters.append(f"indicator_code IN ({sql_list(indicators)})")
+    if years is not None:
+        filters.append(f"year IN ({','.join([str(int(x)) for x in years])})")
+    if countries is not None:
+        filters.append(f"country_code IN ({sql_list(countries)})")
+
+    return f"WHERE {' AND '.join(filters)}" if len(filters) > 0 else ""
+
+
+def wdi_indicators(conn: ib.backends.duckdb.Backend, store_path: str = wdi_store_path, source: str = wdi_file) -> ib.Table:
+    """Indicator codes and names of the WDI store."""
+    check_wdi(conn, store_path, source=source)
+
+    return conn.read_parquet(wdi_indicators_filename(store_path))
+
+
+def wdi_codes(conn: ib.backends.duckdb.Backend, names, store_path: str = wdi_store_path) -> dict:
+    """Codes of indicators given by name, as {name : code}. Names not in WDI are left out."""
+    indicators = wdi_indicators(conn, store_path)
+
+    return (indicators
+            .filter(indicators.indicator_name.isin(list(names)))
+            .execute()
+            .set_index("indicator_name")["indicator_code"]
+            .to_dict())
+
+
+def read_wdi(conn: ib.backends.duckdb.Backend, indicators: list = None, years: list = None, countries: list = None, store_path: str = wdi_store_path) -> ib.Table:
+    """Long WDI table (country_code, country_name, year, indicator_code, indicator_name, value).
+    Only the partitions of 'indicators' are read, all the filters are optional.
+    """
+    check_wdi(conn, store_path)
+
+    return conn.sql(f"""
+    SELECT w.country_code, c.country_name, w.year, w.indicator_code, i.indicator_name, w.value
+    FROM (SELECT * FROM read_parquet('{store_path}/**/*.parquet', hive_partitioning=true) {wdi_filter(indicators, years, countries)}) w
+        LEFT JOIN read_parquet('{wdi_countries_filename(store_path)}') c USING (country_code)
+        LEFT JOIN read_parquet('{wdi_indicators_filename(store_path)}') i USING (indicator_code);
+    """)
+
+
+def wdi_matrix(conn: ib.backends.duckdb.Backend, indicators: list, years: list = None, countries: list = None, store_path: str = wdi_store_path) -> ib.Table:
+    """Country x indicator table : one row per (country_code, year) with a column per indicator code, null where WDI has no value.
+    Every country (of 'countries') has a row for every year (of 'years'), as in the wide csv.
+    """
+    check_wdi(conn, store_path)
+
+    values = ", ".join([f"max(w.value) FILTER (WHERE w.indicator_code='{x}') as \"{x}\"" for x in indicators])
+    year_values = f"SELECT unnest([{','.join([str(int(x)) for x in years])}]) as year" if years is not None else "SELECT DISTINCT year FROM w"
+    country_filter = f"WHERE country_code IN ({sql_list(countries)})" if countries is not None else ""
+
+    return conn.sql(f"""
+    WITH w AS (SELECT * FROM read_parquet('{store_path}/**/*.parquet', hive_partitioning=true) {wdi_filter(indicators, years, countries)}),
+        keys AS (SELECT * FROM (SELECT * FROM read_parquet('{wdi_countries_filename(store_path)}') {country_filter}), ({year_values}))
+    SELECT keys.country_code, any_value(keys.country_name) as country_name, keys.year, {values}
+    FROM keys LEFT JOIN w USING (country_code, year)
+    GROUP BY keys.country_code, keys.year
+    ORDER BY keys.country_code, keys.year;
+    """)
+
+if __name__ == "__main__":
+    import scalenav.oop as snoo
+
+    conn = snoo.sn_connect(interactive=False)
+    cache_dose(conn)
+    cache_wdi(conn)
@@ -0,0 +1,137 @@
+# gap_filling.py
+"""Filling of the missing values of DOSE like tables from accounting identities.
+
+An identity is declared as a total (lhs) and its parts (rhs), e.g. GDP = agriculture + manufacturing + services.
+For each row :
+    - the total is missing and all the parts are present : the total is the sum of the parts.
+    - the total is present and a single part is missing : the part is the total minus the other parts.
+Rows with more gaps are left as they are. The rules are applied on whole columns with masks, and each fill is counted.
+
+    dose, report = fill_identity(dose, sector_identity("usd_2015"))
+
+The regions missing from DOSE in a partially covered country get the residual of the country, the national value minus
+the sum of its regions, shared by weight (uniform, area, population, ...) in a single groupby over all the countries and years.
+
+    residual = residuals(wdi, dose, sector_identity("usd_2015"))
+    dose_missing = allocate_residuals(residual, missing_regions, columns, weights=areas)
+"""
+import pandas as pd
+
+sectors = ["agriculture", "manufacturing", "services"]
+
+
+def sector_identity(suffix: str, total: str = "grp", parts: list = sectors) -> dict:
+    """Identity between the total and the sector columns sharing a suffix, e.g. 'usd_2015' : grp_usd_2015 = agriculture_usd_2015 + ..."""
+    return {
+        "lhs" : f"{total}_{suffix}",
+        "rhs" : [f"{x}_{suffix}" for x in parts],
+    }
+
+
+def fill_identity(df: pd.DataFrame, identity: dict, inplace: bool = False) -> tuple:
+    """Fill the gaps of 'df' following 'identity' ({"lhs" : column, "rhs" : [columns]}).
+    Returns the filled table and a report of the number of cells filled by each rule, per column.
+    """
+    if not inplace:
+        df = df.copy()
+
+    lhs, rhs = identity["lhs"], identity["rhs"]
+
+    missing_rhs = df[rhs].isna()
+    n_missing_rhs = missing_rhs.sum(axis=1)
+    missing_lhs = df[lhs].isna()
+
+    report = []
+
+    # total from the sum of the parts
+    lhs_rule = missing_lhs & (n_missing_rhs == 0)
+    df.loc[lhs_rule, lhs] = df.loc[lhs_rule, rhs].sum(axis=1)
+    report.append({"rule" : "lhs_from_rhs", "column" : lhs, "filled" : int(lhs_rule.sum())})
+
+    # a single missing part from the total minus the others, the masks are taken before any fill
+    rhs_rule = ~missing_lhs & (n_missing_rhs == 1)
+    remainder = df[lhs] - df[rhs].sum(axis=1)
+    for col in rhs:
+        mask = rhs_rule & missing_rhs[col]
+        df.loc[mask, col] = remainder[mask]
+        report.append({"rule" : "rhs_from_lhs", "column" : col, "filled" : int(mask.sum())})
+
+    return df, pd.DataFrame(report)
+
+
+def fill_identities(df: pd.DataFrame, identities: list, inplace: bool = False) -> tuple:
+    """Apply several identities in turn, the reports are concatenated."""
+    reports = []
+    for identity in identities:
+        df, report = fill_identity(df, identity, inplace=inplace)
+        reports.append(report)
+
+    return df, pd.concat(reports, ignore_index=True)
+
+
+def residuals(national: pd.DataFrame, regional: pd.DataFrame, identity: dict, keys: list = ["gid_0", "year"]) -> pd.DataFrame:
+    """National values minus the sum of the regions, per 'keys', for the columns of 'identity'.
+    The total residual is set to 0 when the regions sum above the national value. The residuals of the parts, each at least 0,
+    are rescaled to sum to the total residual, so that the identity holds for the residuals and for the regions they are
+    allocated to. Parts with no positive residual share the total as the national parts.
+    """
+    lhs, rhs = identity["lhs"], identity["rhs"]
+    columns = [lhs, *rhs]
+
+    regional_sum = regional.groupby(keys)[columns].sum(min_count=1)
+    national = national.set_index(keys)[columns]
+    residual = (national - regional_sum.reindex(national.index).fillna(0)).clip(lower=0)
+
+    parts = residual[rhs]
+    # no positive part left, e.g. all the sectors of the regions above the national ones
+    no_parts = parts.sum(axis=1) == 0
+    parts = parts.mask(no_parts, national[rhs], axis=0)
+
+    residual[rhs] = parts.mul(residual[lhs] / parts.sum(axis=1), axis=0)
+    # a null total residual, and no national parts to share it
+    residual.loc[residual[lhs] == 0, rhs] = 0
+
+    return residual.reset_index()
+
+
+def identity_errors(df: pd.DataFrame, identity: dict, rtol: float = 1e-9) -> pd.DataFrame:
+    """Rows of 'df' with all the columns of 'identity' present where the total differs from the sum of the parts."""
+    lhs, rhs = identity["lhs"], identity["rhs"]
+
+    complete = df[[lhs, *rhs]].notna().all(axis=1)
+    error = (df[lhs] - df[rhs].sum(axis=1)).abs() > rtol * df[lhs].abs()
+
+    return df[complete & error]
+
+
+def allocation_shares(missing: pd.DataFrame, weights: pd.DataFrame = None, keys: list = ["gid_0", "year"], region: str = "gid_1") -> pd.DataFrame:
+    """Share of each missing region in the residual of its country and year.
+    'weights' is a (region, weight) table, with a year column for yearly weights, e.g. the areas or populations of the regions.
+    Uniform shares without weights, or for the countries where a region has no weight.
+    """
+    shares = missing[[*keys, region]].drop_duplicates().assign(weight=1.0)
+
+    if weights is not None:
+        on = [x for x in [region, "year"] if x in weights.columns]
+        shares = shares.drop(columns="weight").merge(weights[[*on, "weight"]], on=on, how="left")
+
+        # any region without weight and the country falls back to uniform
+        no_weight = shares["weight"].isna() | (shares["weight"] <= 0)
+        uniform = no_weight.groupby([shares[x] for x in keys]).transform("any")
+        shares["weight"] = shares["weight"].where(~uniform, 1.0)
+
+    shares["share"] = shares["weight"] / shares.groupby(keys)["weight"].transform("sum")
+
+    return shares.drop(columns="weight")
+
+
+def allocate_residuals(residual: pd.DataFrame, missing: pd.DataFrame, columns: list, weights: pd.DataFrame = None,
+                       keys: list = ["gid_0", "year"], region: str = "gid_1") -> pd.DataFrame:
+    """Spread the 'residual' of each country and year over its 'missing' regions, proportionally to 'weights'.
+    Every country and year is allocated at once, one row per missing region.
+    """
+    shares = allocation_shares(missing, weights, keys=keys, region=region)
+    allocated = shares.merge(residual[[*keys, *columns]], on=keys, how="inner")
+    allocated[columns] = allocated[columns].mul(allocated["share"], axis=0)
+
+    return allocated
@@ -0,0 +1,67 @@
+# h3_utils.py
+"""H3 helpers shared by the POI pipelines.
+
+The POIs are projected once at a fine resolution, the parent cells for a range of coarser resolutions are derived from it and stored
+alongside as 'h3_id_{res}' columns. Aggregating at a coarser resolution is then a plain groupby on an existing column.
+
+Cell ids are stored and joined as UBIGINT (uint64) everywhere, half the bytes of the hex strings and faster to hash in the joins.
+They are only turned into strings for pydeck (H3HexagonLayer), with 'to_strings'.
+"""
+import ibis as ib
+import pandas as pd
+
+
+def project(table: ib.Table, res: int, x: str = "x", y: str = "y", column: str = "h3_id") -> ib.Table:
+    """Add the cell at 'res' of the points 'x'/'y' of a table as a UBIGINT 'column'."""
+    # an existing cell column is replaced
+    exclude = f"EXCLUDE ({column})" if column in table.columns else ""
+
+    return table.alias("proj").sql(f"""
+    SELECT * {exclude}, h3_latlng_to_cell({y}, {x}, {res})::UBIGINT as {column} FROM proj;
+    """)
+
+
+def as_cell_ids(table: ib.Table, column: str = "h3_id") -> ib.Table:
+    """Cast a cell column read from an older output to UBIGINT, hex strings are converted. Integer columns are left as they are."""
+    if not table[column].type().is_string():
+        return table.cast({column : "uint64"})
+
+    return table.alias("ids").sql(f"""
+    SELECT * REPLACE (h3_string_to_h3({column})::UBIGINT as {column}) FROM ids;
+    """)
+
+
+def to_strings(df: pd.DataFrame, column: str = "h3_id") -> pd.DataFrame:
+    """Hex string cell ids for pydeck, which can not read uint64 cells. Only meant for the aggregated data to plot."""
+    return df.assign(**{column : df[column].map(lambda cell : format(int(cell), "x"))})
+
+
+def pyramid_column(res: int) -> str:
+    return f"h3_id_{res}"
+
+
+def add_pyramid(table: ib.Table, res_range, fine_res: int, column: str = "h3_id") -> ib.Table:
+    """Add the parent cells of 'column' (at 'fine_res') for each resolution of 'res_range'. Resolutions not coarser than 'fine_res' are skipped."""
+    parents = ", ".join([f"h3_cell_to_parent({column}, {res}) as {pyramid_column(res)}" for res in res_range if res < fine_res])
+
+    # no coarser resolution, nothing to add
+    if parents == "":
+        return table
+
+    return table.alias("pyr").sql(f"""
+    SELECT *, {parents} FROM pyr;
+    """)
+
+
+def at_res(table: ib.Table, res: int, column: str = "h3_id") -> ib.Table:
+    """Use the stored parent at 'res' as the cell column, in place of a reprojection of the points.
+    The other pyramid columns are dropped.
+    """
+    if pyramid_column(res) not in table.columns:
+        raise ValueError(f"No pyramid column for resolution {res}, available : {[x for x in table.columns if x.startswith('h3_id_')]}")
+
+    pyramid = [x for x in table.columns if x.startswith("h3_id_")]
+
+    return (table
+            .mutate(**{column : table[pyramid_column(res)]})
+            .drop(*pyramid))
@@ -18,7 +18,10 @@
 #   - Total : not considered
 # 
 
-# For a selected year of interest
+# For a selected year of interest, or all the years of 'years' in one run (parameters.py)
+# 
+# The steps are functions, run by main() when the file is executed : importing it runs nothing.
+#     python missing_countries.py
 # 
 # ### Outline of the steps
 # 
@@ -35,7 +38,7 @@
 #     The relevant variables from here are Agriculture, Manufacturing and Services proportions of GDP. Adding Venezuala manually from the CIA factbook.
 # 
 # [Missing population](missing_pop):
-#     A subset of regions have missing population data in DOSE. Filling them from local stat offices where available or the citypopulation.de portal.
+#     A subset of regions have missing population data in DOSE. Filling them from local stat offices where available or the citypopulation.de portal, listed in the override table (data/overrides/overrides.csv).
 # 
 # [Combining the two sources](combining):
 #     The two tables are concatenated. 
@@ -44,340 +47,35 @@
 #     We have GDP = agriculture + manufacturing + services. If any single value of the rhs is missing, we can find it. If lhs is missing, we can sum rhs.
 # 
 # [Partially missing regions](partial_miss):
-#     Not yet fully solved as things tend not to add up properly. WIP
+#     The national residual of the incomplete countries is allocated to their missing regions (gap_filling.py).
 # 
 # 
 # 
 
 # ***
 
-# In[1]:
-
-
-import json
-import io
 import re
-import itertools as iter
-import numpy as np
 import os
-from random import sample
-from pathlib import Path
-
-from matplotlib import pyplot as plt
-# data
 
 import pandas as pd
+import pyarrow as pa
 import ibis as ib
-from ibis import _
-ib.options.interactive = True
 
 from scalenav.oop import sn_connect
 
-from parameters import year,missing_frac
-
-
-# In[2]:
-
-
-# The duckdb/ibis way require to either create an in-memory database at the moment of execution of the notebook, or saving the database in a file. 
-conn = sn_connect()
-conn.list_tables() # empty
-
-
-# ### Enter A YEAR OF INTEREST IN parameters.py
-
-# Reading in data
-# 
-# With **ibis**
-
-# In[3]:
-
-
-Path.cwd()
-print(Path(os.getcwd()))
-
-
-# In[ ]:
-
-
-dose_file = "../datasets/DOSE/V2.10/DOSE_V2.10.csv"
-
-
-# In[4]:
-
-
-dose = conn.read_csv(dose_file,table_name="dose",all_varchar = True)
-
-
-# In[5]:
-
-
-wdi = conn.read_csv("../datasets/WDI_CSV_2024_06_28/WDICSV.csv",table_name="wdi")
-
-
-# In[6]:
-
-
-# the merged file
-# local path with folder where the downloaded shapefiles are stored 
-# (both GADM and the custom one)
-gadm_path = '../datasets/DOSE/V2/DOSE_replication_files/DOSE_replication_files/Data/spatial data/' # ../../../../../
-
-# Read shapefiles
-file_name = "gadm36_1"
-# gpd.list_layers(gadm_path+file_name+".gpkg")
-
-# gadm = gpd.read_file(gadm_path+"gadm36_levels_shp/" + file_name+".shp")
-# has to be downloaded from https://gadm.org/download_world36.html; follow instructions in readme
-
-
-# In[7]:
-
-
-# ../datasets/boundaries/GADM/gadm_410.gpkg
-conn.raw_sql(f"""CREATE OR REPLACE TABLE boundaries AS SELECT * FROM st_read('{gadm_path+"gadm36_levels_shp/" + file_name+".shp"}');""") 
-
-
-# In[8]:
-
-
-boundaries = conn.table("boundaries")
-
-
-# In[9]:
-
-
-boundaries = boundaries.rename("snake_case")
-
-
-# In[10]:
-
-
-boundary_countries = conn.sql("Select distinct(gid_0) from boundaries;").to_pandas().iloc[:,0].to_list()
-print(len(boundary_countries))
-sample(boundary_countries,k=5)
-
-
-# ### Inspection
-
-# #### Changing column names for easier manipulation
-
-# In[15]:
-
-
-# cool function from ibis, no need for the previous cells, althought the python dict comprehension method is cool as well.
-wdi = wdi.rename("snake_case")
-dose = dose.rename("snake_case")
-
-
-# #### Country codes in the data sets
-
-# In[19]:
-
-
-wdi_countries = np.unique(wdi.country_code.__array__()).tolist()
-
-
-# In[21]:
-
-
-dose_countries = dose.filter(_.year==str(year)).gid_0.to_pandas().unique().tolist()
-dose_countries[0:5]
-
-
-# ## [Country representation](#country_repr)
-
-# In[23]:
-
-
-# in dose, there is an uneven representation of regions from one year to another.
-# using boundaries as the baseline to how many sub national entities should be in a country 
-boundary_sizes = boundaries.gid_0.value_counts() #.execute().set_index("gid_0")
-
-
-# In[24]:
-
-
-dose_representation = (
-    dose
-    .filter(_.year==str(year))
-    .gid_0
-    .value_counts()
-)
-
-
-# In[25]:
-
-
-bound_complete = (
-    boundary_sizes
-    .join(dose_representation,
-           how="left",
-           lname="{name}_bound",
-           rname = "{name}_dose",
-           predicates="gid_0",)
-    .mutate(repr_frac=_.gid_0_count_dose/_.gid_0_count_bound)
-    .fill_null({"gid_0_count_dose" : 0})
-)
-
-
-# In[26]:
-
-
-bound_complete.count()
-
-
-# In[27]:
-
-
-bound_complete.head(10)
-
-
-# In[28]:
-
-
-bound_complete_df = bound_complete.execute()
-
-
-# In[29]:
-
-
-# missing values are dropped here when executing, leaving only the indices of countries that are in both but the representation is less than 1
-incomplete_countries_year = bound_complete.filter(_.repr_frac<1).gid_0_bound.execute().to_list()
-
-# this means that for the selected year there are the following number of incomplete countries in DOSE.
-len(incomplete_countries_year)
-
-
-# In[30]:
-
-
-incomplete_countries_year[0:5]
-
-
-# In[31]:
-
-
-missing_countries_year = bound_complete.filter(_.gid_0_count_dose==0).gid_0_bound.execute().to_list()
-
-
-# In[32]:
-
-
-len(missing_countries_year)
-
-
-# In[33]:
-
-
-missing_countries_year[0:5]
-
-
-# ## [Missing regions](#missing_reg)
-# Determining the missing regions from DOSE using the 3 letter country codes compared to the equivalent variable in WDI indicators
-
-# In[34]:
-
-
-# # dose.filter(_.country=="Nigeria").count()
-# boundaries.filter(_.name_0=="Ethiopia")
-
+from parameters import years,allocation_weights,version,dose_wdi_path
+import econ_data as ecd
+import gap_filling as gf
+import coverage as cov
+import overrides as ovr
+import stage_cache as sc
+import dose_wdi as dwi
+import boundary_cache as bc
 
-# In[35]:
-
-
-dose_regions = (
-    dose
-    .filter(_.year==str(year))
-    .gid_1
-    .execute()
-    .unique()
-    .tolist()
-)
-
-
-# In[36]:
-
-
-dose_regions[0:5]
-
-
-# In[37]:
-
-
-len(dose_regions)
-
-
-# In[38]:
-
-
-bound_regions = (
-    boundaries
-    # .filter(~_.gid_1.isin(dose_regions))
-    .gid_1
-    .execute()
-    .tolist()
-)
-
-
-# In[39]:
-
-
-missing_regions = [x for x in bound_regions if x not in dose_regions]
-
-
-# In[41]:
-
-
-full_missing_regions_df = pd.DataFrame([x.split(".") for x in missing_regions],columns=["country","region"])
-
-
-# In[42]:
-
-
-full_missing_regions_df
-
-
-# In[43]:
-
-
-dose_missing_regions = full_missing_regions_df.loc[full_missing_regions_df.country.isin(incomplete_countries_year)].reset_index(drop=True)
-
-
-# In[44]:
-
-
-dose_missing_regions
-
-
-# ### [WDI of interest](#wdi)
-# 
-# getting the variables of interest from the WDI index for the missing countries in the DOSE data set.
-
-# In[46]:
-
-
-# should not be null
-wdi.filter(_.country_code.isin(incomplete_countries_year)).order_by("country_name").head(5)
-
-
-# In[47]:
-
-
-indicators = wdi.indicator_name.to_pandas().unique().tolist()
-indicators[0:9]
-
-
-# In[48]:
-
-
-# subsetting the variables with relevant currency as constant 2015 values
-# [x for x in indicators if re.search(string=x,pattern="constant 2015 US\\$")]
-# [x for x in indicators if re.search(string=x,pattern="\\% of GDP")]
-
-
-# In[49]:
+sector_columns = ["grp_usd_2015","services_usd_2015","manufacturing_usd_2015","agriculture_usd_2015"]
 
+# ratio of the sum of the sectors to the total above which a region is reported as inconsistent
+gdp_thres = 1.1
 
 # manually getting the useful variables and storing in a dict with simplified names.
 indicators_of_intereset_perc = {
@@ -396,442 +94,166 @@ indicators_of_intereset_usd_2015 = {
     "industry_usd_2015" : "Industry (including construction), value added (constant 2015 US$)",
     "services_usd_2015" : "Services, value added (constant 2015 US$)",
     "agriculture_usd_2015" : "Agriculture, forestry, and fishing, value added (constant 2015 US$)",
-    
 }
 
-
-# In[50]:
-
-
 # select here which dict of indicators to use : the _usd_2015 is considered only at this point
 indicators_of_intereset = indicators_of_intereset_usd_2015
 
 
-# In[51]:
-
-
-if str(year) not in wdi.columns:
-    raise ValueError("No such year ({}) in WDI data".format(year))
-
-
-# In[52]:
+def dose_light_filename(version: str = version) -> str:
+    """Directory of the combined data set, partitioned by year : {dose_wdi_path}{version}/dose_light_combined_{version}/year=2015/..."""
+    return f"{dose_wdi_path}{version}/dose_light_combined_{version}"
 
 
-wdi_cols = ["country_name","country_code","indicator_name","indicator_code",str(year)]
-
-# keeping indicators of interest and countries of interest
-wdi_of_interest = wdi.select(wdi_cols).filter(_.indicator_name.isin(indicators_of_intereset.values()))
-
-
-# In[53]:
-
-
-# get the data of interest into a pandas df
-wdi_df = wdi_of_interest.filter(_.country_code.isin(missing_countries_year)).to_pandas()
-
-
-# ### Manually adding Venezuela
-
-# In[55]:
-
-
-# filling available values for Venzuela from other sources.
-# This source: https://www.cia.gov/the-world-factbook/countries/venezuela/#economy
-
-gdp_2017 = 334.751e9
-gdp_pc_2017 = 9_417 
-
-manuf_gdp_frac = 0.404
-serv_gdp_frac = 0.549
-agri_gdp_frac = 0.047
-
-venezuela_gaps = {"indicator_code" : ["NV.AGR.TOTL.KD","NY.GDP.MKTP.KD","NY.GDP.PCAP.KD","NV.IND.TOTL.KD","NV.SRV.TOTL.KD"]
-                  ,str(year) : [agri_gdp_frac*gdp_2017, gdp_2017, gdp_pc_2017, manuf_gdp_frac*gdp_2017, serv_gdp_frac*gdp_2017]
-                  ,"country_code" : ["VEN"]*5}
-
-venezuela_gaps_df = pd.DataFrame(venezuela_gaps).set_index(["indicator_code","country_code"])
-
-venezuela_gaps_df
-
-
-# In[56]:
-
-
-wdi_df.set_index(["indicator_code","country_code"],inplace=True)
-
-
-# In[57]:
-
-
-wdi_df.loc[venezuela_gaps_df.index,"2015"]=venezuela_gaps_df
-
-
-# In[58]:
-
-
-wdi_df.reset_index(inplace=True,drop=False)
-
-
-# ## WDI data transformed
-# pivoting the data WDI data
-
-# In[61]:
-
-
-wdi_df_var = wdi_df.pivot(columns=["indicator_name",],values=[str(year)],index=["country_name","country_code"]).reset_index()
-
-
-# In[62]:
-
-
-wdi_df_var.rename(columns={v:k for (k,v) in indicators_of_intereset.items()} # inverting the indicators of interest to rename columns
-                  ,inplace=True)
-
-
-# In[63]:
-
-
-wdi_df_var.columns = [x[1] if x[1]!='' else x[0] for x in wdi_df_var.columns]
-
-
-# In[64]:
-
-
-wdi_df_var.columns = [x.replace("industry", "manufacturing") if re.search(string=x,pattern="industry_") else x for x in wdi_df_var.columns]
-
-
-# In[67]:
-
-
-# without 'manufacturing' it makes more sense:
-indicator_columns = [x for x in wdi_df_var.columns if re.search(string=x,pattern="(services_)|(agriculture_)|(manufacturing_)")]
-indicator_columns
-
-
-# ## Combining the data sets
-
-# ### Using the year variable assigned earlier
-
-# In[72]:
-
-
-dose_year = dose.filter(_.year==str(year)).to_pandas()
-
-
-# In[73]:
-
+# ## [Country representation](#country_repr)
+# ## [Missing regions](#missing_reg)
 
-# due to the way na values are written in the data set, all the data had to be read as strings, changing this here.
-dose_year.replace(to_replace="#N/A",value=np.nan,inplace=True)
+def load_boundaries(conn: ib.backends.duckdb.Backend, level: str = "1km") -> ib.Table:
+    """GADM 3.6 and custom ADM1 regions, the reference of how many sub national entities should be in a country.
+    From the GeoParquet cache (boundary_cache.py), the coarse level is enough for the ids and the areas.
+    """
+    return bc.read_boundaries(conn,level=level)
+
+
+def coverage_stage(boundaries: ib.Table, dose: ib.Table, years: list = years) -> pd.DataFrame:
+    """Coverage of the regions of the boundaries in DOSE, one query for all the years (coverage.py)."""
+    return cov.coverage(boundaries,dose,years=years).execute()
+
+
+def country_coverage(coverage_df: pd.DataFrame, dose: ib.Table, years: list = years) -> dict:
+    """Country and region lists of the gap filling, from the coverage table.
+    In dose, there is an uneven representation of regions from one year to another, the lists are per year.
+    """
+    missing_regions_df = cov.missing_regions(coverage_df)
+    incomplete_country_years = cov.incomplete_countries(coverage_df,by_year=True)
+
+    # all the DOSE countries, the ones without boundaries have no coverage but still get their WDI fractions
+    dose_countries = cov.dose_countries(dose,years=years)
+    unmatched_countries = cov.unmatched_countries(coverage_df,dose_countries)
+    if len(unmatched_countries) > 0:
+        print(f"DOSE countries without regions in the boundaries, not in the coverage : {unmatched_countries}")
+
+    return {
+        "coverage" : coverage_df,
+        # the years processed, all the DOSE years when 'years' is None
+        "run_years" : sorted(coverage_df.year.unique().tolist()),
+        "dose_countries" : dose_countries,
+        "unmatched_countries" : unmatched_countries,
+        # countries in dose for which the representation is less than 1, and per year, as (year, gid_0)
+        "incomplete_countries" : cov.incomplete_countries(coverage_df),
+        "incomplete_country_years" : incomplete_country_years,
+        "missing_countries" : cov.missing_countries(coverage_df),
+        "missing_country_years" : cov.missing_countries(coverage_df,by_year=True),
+        "missing_regions" : missing_regions_df,
+        # missing regions of the incomplete countries, (year, gid_0, gid_1)
+        "incomplete_missing_regions" : missing_regions_df.merge(incomplete_country_years,on=["year","gid_0"]),
+    }
 
 
-# On the duckdb end all the data was stored as strings becuase the NA values were not interpretable as numeric. so converting back 
+# ### [WDI of interest](#wdi)
 # 
+# getting the variables of interest from the WDI index for the countries of DOSE.
 
-# In[76]:
-
-
-# The columns that we will use later will be multiplied, so this step is essential as the automatic type is sometimes wrong.
-float_cols = dose_year.filter(regex="(lcu)|(usd)|(cpi)|(pop)|(year)|(T_a)|(P_a)|(PPP)|(2015)").columns.unique()
-dose_year[float_cols] = dose_year[float_cols].astype(float)
-
-
-# In[77]:
-
-
-gdp_thres = 1.1
+def check_wdi_years(conn: ib.backends.duckdb.Backend, run_years: list):
+    wdi_years = ecd.read_wdi(conn,indicators=["NY.GDP.MKTP.KD"],years=run_years).year.to_pandas().unique()
+    if any([x not in wdi_years for x in run_years]):
+        raise ValueError("No such year ({}) in WDI data".format([x for x in run_years if x not in wdi_years]))
 
 
-# In[78]:
+def wdi_names(conn: ib.backends.duckdb.Backend, indicators: dict = indicators_of_intereset) -> tuple:
+    """Codes of the indicators of interest, and the simplified names of the matrix columns."""
+    wdi_codes = ecd.wdi_codes(conn,indicators.values())
+    wdi_rename = {"country_name" : "country", **{wdi_codes[v]:k for (k,v) in indicators.items() if v in wdi_codes}}
 
+    return wdi_codes, wdi_rename
 
-#  IN NORMAL LCU
-# But before checking if things add up
-# 'grp_pc_lcu_2015',
-#  'ag_grp_pc_lcu_2015',
-#  'man_grp_pc_lcu_2015',
-#  'serv_grp_pc_lcu_2015',
 
-dose_year["manufacturing_lcu_2015"] = dose_year["man_grp_pc_lcu_2015"]*dose_year["pop"]
-dose_year["services_lcu_2015"]=dose_year['serv_grp_pc_lcu_2015']*dose_year["pop"]
-dose_year["agriculture_lcu_2015"]=dose_year['ag_grp_pc_lcu_2015']*dose_year["pop"]
-dose_year["grp_lcu_2015"]=dose_year["grp_pc_lcu_2015"]*dose_year["pop"]
+def wdi_table(conn: ib.backends.duckdb.Backend, run_years: list, countries: list, indicators: dict = indicators_of_intereset, overrides: bool = True) -> pd.DataFrame:
+    """country x indicator matrix for the years with the simplified names, only the partitions of the indicators of interest are read.
+    Manufacturing in DOSE is linked to industry in WDI. The WDI overrides are applied with 'overrides'.
+    """
+    wdi_codes, wdi_rename = wdi_names(conn, indicators)
 
+    wdi_df = (ecd.wdi_matrix(conn,indicators=list(wdi_codes.values()),years=run_years,countries=countries)
+              .to_pandas())
 
+    # ### Manually adding Venezuela
+    # filling available values for Venzuela from other sources, the CIA factbook 2017 values are in the override table (overrides.py).
+    # the values of their year replace WDI, the other years processed only take them where WDI has no value
+    if overrides:
+        wdi_overrides = ovr.load_overrides("wdi")
+        for indicator_code in wdi_overrides.variable.unique():
+            if indicator_code in wdi_df.columns:
+                wdi_df, _report = ovr.apply_overrides(wdi_df,wdi_overrides,indicator_code,only_missing=False,gid_0="country_code",gid_1=None,region=None)
+                wdi_df, _report = ovr.apply_overrides(wdi_df,wdi_overrides.assign(year=pd.NA),indicator_code,only_missing=True,gid_0="country_code",gid_1=None,region=None)
 
-print("Inconsistencies in the DOSE data set in LCU_2015.")
-print("When converting to absolute values : ",dose_year[((dose_year["manufacturing_lcu_2015"]+dose_year["services_lcu_2015"]+dose_year["agriculture_lcu_2015"])/dose_year["grp_lcu_2015"])>gdp_thres].shape[0])
-print("In pc values : ", dose_year[((dose_year["man_grp_pc_lcu_2015"]+dose_year["serv_grp_pc_lcu_2015"]+dose_year["ag_grp_pc_lcu_2015"])/dose_year["grp_pc_lcu_2015"])>gdp_thres].shape[0])
+    wdi_df = wdi_df.rename(columns=wdi_rename)
+    wdi_df.columns = [x.replace("industry", "manufacturing") if re.search(string=x,pattern="industry_") else x for x in wdi_df.columns]
 
+    return wdi_df
 
-# In[79]:
 
+def wdi_df_full_stage(conn: ib.backends.duckdb.Backend, run_years: list, dose_countries: list, missing_regions: pd.DataFrame) -> pd.DataFrame:
+    """WDI of the countries of DOSE, without the overrides."""
+    # wdi_df_full contains the same countries as the original dose
+    wdi_df_full = wdi_table(conn,run_years,dose_countries,overrides=False)
 
-# #  IN LCU2015_USD whatever it means
+    return wdi_df_full[~wdi_df_full.country_code.isin(missing_regions.gid_1)]
 
-# 'grp_pc_lcu2015_usd',
-#        'ag_grp_pc_lcu2015_usd', 'man_grp_pc_lcu2015_usd',
-#        'serv_grp_pc_lcu2015_usd'
 
-dose_year["manufacturing_lcu_2015_usd"] = dose_year["man_grp_pc_lcu2015_usd"]*dose_year["pop"]
-dose_year["services_lcu_2015_usd"]=dose_year['serv_grp_pc_lcu2015_usd']*dose_year["pop"]
-dose_year["agriculture_lcu_2015_usd"]=dose_year['ag_grp_pc_lcu2015_usd']*dose_year["pop"]
-dose_year["grp_lcu_2015_usd"]=dose_year["grp_pc_lcu2015_usd"]*dose_year["pop"]
-
-print("Inconsistencies in the DOSE data set in LCU2015_USD.")
-print("When converting to absolute values : ",dose_year[((dose_year["manufacturing_lcu_2015_usd"]+dose_year["services_lcu_2015_usd"]+dose_year["agriculture_lcu_2015_usd"])/dose_year["grp_lcu_2015_usd"])>gdp_thres].shape[0])
-print("In pc values : ", dose_year[((dose_year["man_grp_pc_lcu2015_usd"]+dose_year["serv_grp_pc_lcu2015_usd"]+dose_year["ag_grp_pc_lcu2015_usd"])/dose_year["grp_pc_lcu2015_usd"])>gdp_thres].shape[0])
+def wdi_df_var_stage(conn: ib.backends.duckdb.Backend, run_years: list, missing_countries: list, missing_country_years: pd.DataFrame) -> pd.DataFrame:
+    """WDI of the countries missing from DOSE, for the years they are missing."""
+    return (wdi_table(conn, run_years, missing_countries)
+            .merge(missing_country_years,left_on=["year","country_code"],right_on=["year","gid_0"])
+            .drop(columns="gid_0"))
 
 
 # ## [Filling population gaps in DOSE](#missing_pop)
 # The missing *population* values generates missing values when converting from per capita values back into absolute values.
-# 
-# #### Converting per capita into absolute values with the population variable.
-
-# In[82]:
-
-
-# filling some extra missing values of population to reconstruct the economic indicators. From sources on the net.
-missing_pop = dose_year.loc[dose_year["pop"].isna(),["country","region","pop"]].copy()
-# missing_pop.head()
-# # writing out this file to refer to the missing values
-# missing_pop["region"].to_csv("missing_pop.csv",index=False) 
-
-missing_pop.set_index("region",inplace=True)
-
-
-# In[83]:
-
-
-## strangely, Ireland is missing from the data, using it's census data to fill the gaps.
-# https://data.gov.ie/dataset/population-classified-by-area 
-
-# this data set : https://www.cso.ie/en/media/csoie/census/documents/saps2011files/AllThemesTablesCTY.csv
-
-ireland = pd.read_csv("../datasets/support_data/ireland/AllThemesTablesCTY.csv"
-                      ,encoding="UTF-8")
-ireland.columns = [x.lower() for x in ireland.columns]
-ireland.head(3)
-
-# manually replaced Dublin City -> Dublin, Laois -> Laoighis in the data set.
-
-# to many columns
-ireland = ireland[["t1_1agett","geogdesc"]]
-
-
-# In[84]:
-
-
-# renaming consistently
-ireland.rename(columns={"t1_1agett":"pop"
-                        ,"geogdesc":"region"},inplace=True)
-
-# few cases to treat individually
-tipperary_pop = ireland.loc[ireland.region.isin(["Tipperary North","Tipperary South"]),"pop"].sum()
-
-missing_case = pd.DataFrame([{"region" : "Tipperary", "pop" : tipperary_pop}])
-
-ireland = pd.concat([ireland,missing_case])
-
-ireland.set_index("region",inplace=True)
-# ireland.head()
-
-
-# In[85]:
-
-
-missing_index = [x for x in ireland.index if x in missing_pop.index]
-
-
-# In[86]:
-
-
-missing_pop.loc[missing_index,"pop"] = ireland.loc[missing_index,"pop"]
-
-
-# In[88]:
-
-
-# need to go back and forth between indexing based on the region and putting it back into the columns, the R function match() does that well. 
-missing_pop.reset_index(inplace=True,drop=False)
-# missing_pop.head()
-
-
-# In[89]:
-
-
-# the fully manual bit, took some time.
-
-# Argentina
-missing_pop.loc[missing_pop.region=="Neuquen","pop"] = 744_592 # statista : https://www.statista.com/statistics/1413909/population-by-group-age-gender-neuquen-argentina
-missing_pop.loc[missing_pop.region=="Tucuman","pop"] = 1_593_000 # wiki
-
-# Brasil
-missing_pop.loc[missing_pop.region=="Mato Grosso Do Sul","pop"] = 2_833_742 # https://www.britannica.com/place/Mato-Grosso-do-Sul
-missing_pop.loc[missing_pop.region=="Rio De Janeiro","pop"] = 6_625_849 # https://www.britannica.com/place/Rio-de-Janeiro-Brazil
-missing_pop.loc[missing_pop.region=="Rio Grande Do Norte","pop"] = 3_302_729 # https://cidades.ibge.gov.br/brasil/rn/panorama
-missing_pop.loc[missing_pop.region=="Rio Grande Do Sul","pop"] = 11_329_605 # https://www.ceicdata.com/en/brazil/population/population-south-rio-grande-do-sul
-
-# Canada
-missing_pop.loc[missing_pop.region=="Newfoundland And Labrador","pop"] = 541_391 # https://www.gov.nl.ca/fin/economics/eb-population/
-
-#Colombia
-missing_pop.loc[missing_pop.region=="Norte de Santander","pop"] = 1_617_209 # https://www.citypopulation.de/en/colombia/admin/54__norte_de_santander/
-
-# croatia
-missing_pop.loc[missing_pop.region=="Slavonskibrod-Posavina","pop"] = 130_267 # https://www.citypopulation.de/en/croatia/admin/12__brod_posavina/
-
-# Kazakhstan
-missing_pop.loc[missing_pop.region=="Aktobe","pop"] = 944_600 # https://stat.gov.kz/en/region/aktobe/
-missing_pop.loc[missing_pop.region=="Atirau","pop"] = 708_500 # https://stat.gov.kz/en/region/atyrau/
-missing_pop.loc[missing_pop.region=="East Kazakhstan","pop"] = 731_246 # https://www.citypopulation.de/en/kazakhstan/cities/
-missing_pop.loc[missing_pop.region=="Kostanay","pop"] = 827_900 # https://stat.gov.kz/en/region/kostanay/
-missing_pop.loc[missing_pop.region=="North Kazakhstan","pop"] = 540_700 # 
-
-# south Korea
-missing_pop.loc[missing_pop.region=="Gangwond-do","pop"] = 1_521_763 # https://www.citypopulation.de/en/southkorea/admin/32__gangwon_do/
-
-# Tanzania
-missing_pop.loc[missing_pop.region=="Arusha","pop"] = 2_356_255 # https://www.citypopulation.de/en/tanzania/admin/02__arusha/
-missing_pop.loc[missing_pop.region=="Dar es salaam","pop"] = 8_161_231 # https://worldpopulationreview.com/cities/tanzania/dar-es-salaam
-missing_pop.loc[missing_pop.region=="Dodoma","pop"] = 3_085_625 # https://www.citypopulation.de/en/tanzania/admin/01__dodoma/
-missing_pop.loc[missing_pop.region=="Geita","pop"] = 2_977_608 # https://www.citypopulation.de/en/tanzania/admin/25__geita
-missing_pop.loc[missing_pop.region=="Iringa","pop"] = 1_192_728 # http://www.citypopulation.de/en/tanzania/admin/11__iringa/
-missing_pop.loc[missing_pop.region=="Kagera","pop"] = 2_989_299 # https://www.citypopulation.de/en/tanzania/admin/18/
-missing_pop.loc[missing_pop.region=="Katavi","pop"] = 1_152_958 # https://citypopulation.de/en/tanzania/admin/23__katavi/
-missing_pop.loc[missing_pop.region=="Kigoma","pop"] = 2_470_967 # https://citypopulation.de/en/tanzania/admin/
-missing_pop.loc[missing_pop.region=="Kilimanjaro","pop"] = 1_861_934 # ---
-missing_pop.loc[missing_pop.region=="Lindi","pop"] = 1_194_028 # ---
-missing_pop.loc[missing_pop.region=="Manyara","pop"] = 1_892_502 # ---
-missing_pop.loc[missing_pop.region=="Mara","pop"] = 2_372_015 # ---
-missing_pop.loc[missing_pop.region=="Mbeya","pop"] = 2_343_754 # ---
-missing_pop.loc[missing_pop.region=="Morogoro","pop"] = 3_197_104 # ---
-missing_pop.loc[missing_pop.region=="Mtwara","pop"] = 1_634_947 # ---
-missing_pop.loc[missing_pop.region=="Mwanza","pop"] = 3_699_872 # ---
-missing_pop.loc[missing_pop.region=="Njombe","pop"] = 889_946 # ---
-missing_pop.loc[missing_pop.region=="Pwani","pop"] = 2_024_947 # ---
-missing_pop.loc[missing_pop.region=="Rukwa","pop"] = 1_540_519 # ---
-missing_pop.loc[missing_pop.region=="Ruvuma","pop"] = 1_848_794 # ---
-missing_pop.loc[missing_pop.region=="Shinyanga","pop"] = 2_241_299 # ---
-missing_pop.loc[missing_pop.region=="Singida","pop"] = 2_008_058 # ---
-missing_pop.loc[missing_pop.region=="Tabora","pop"] = 3_391_679 # ---
-missing_pop.loc[missing_pop.region=="Tanga","pop"] = 2_615_597 # ---
-
-# Ukraine
-missing_pop.loc[missing_pop.region=="Dnipropetrovsk","pop"] = 1_145_065 # https://www.citypopulation.de/en/ukraine/
-missing_pop.loc[missing_pop.region=="Kyiv City","pop"] = 2_952_301 # https://www.citypopulation.de/en/ukraine/kievcity/
-
-
-# In[90]:
-
-
-# no 'fx' is na
-# dose_year[dose_year["fx"].isna()]
-# NA for gid_0=="ANT"
-# dose_year[dose_year["deflator_2015"].isna()]
-# # dose_year[dose_year.gid_0=="ANT"]
-# lcu_vars = [x for x in dose_year.columns if re.search(string=x,pattern="_lcu")]
-# dose_year[lcu_vars].isna() 
 
+def inconsistencies(dose_year: pd.DataFrame, suffix: str, pc_suffix: str):
+    """Regions where the sectors sum above the total, from the absolute and the per capita values."""
+    absolute = (dose_year[f"manufacturing_{suffix}"]+dose_year[f"services_{suffix}"]+dose_year[f"agriculture_{suffix}"])/dose_year[f"grp_{suffix}"]
+    per_capita = (dose_year[f"man_grp_pc_{pc_suffix}"]+dose_year[f"serv_grp_pc_{pc_suffix}"]+dose_year[f"ag_grp_pc_{pc_suffix}"])/dose_year[f"grp_pc_{pc_suffix}"]
 
-# ### Putting the missing populations back in
+    print(f"Inconsistencies in the DOSE data set in {suffix.upper()}.")
+    print("When converting to absolute values : ",dose_year[absolute>gdp_thres].shape[0])
+    print("In pc values : ", dose_year[per_capita>gdp_thres].shape[0])
 
-# In[91]:
 
+def dose_year_stage(dose: ib.Table) -> pd.DataFrame:
+    """DOSE of the years with the populations filled and the absolute values of the sectors."""
+    # the '#N/A' values are already nulls and the columns typed, see econ_data.dose_schema
+    dose_year = dose.to_pandas()
 
-dose_year.set_index("region",inplace=True)
-missing_pop.set_index("region",inplace=True)
+    #  IN NORMAL LCU, before checking if things add up
+    for sector, pc in [("manufacturing","man_grp_pc"),("services","serv_grp_pc"),("agriculture","ag_grp_pc"),("grp","grp_pc")]:
+        dose_year[f"{sector}_lcu_2015"] = dose_year[f"{pc}_lcu_2015"]*dose_year["pop"]
+        # IN LCU2015_USD whatever it means
+        dose_year[f"{sector}_lcu_2015_usd"] = dose_year[f"{pc}_lcu2015_usd"]*dose_year["pop"]
 
+    inconsistencies(dose_year,"lcu_2015","lcu_2015")
+    inconsistencies(dose_year,"lcu_2015_usd","lcu2015_usd")
 
-# In[92]:
+    # filling some extra missing values of population to reconstruct the economic indicators. From sources on the net.
+    # the values and their sources are in the override table, see overrides.py.
+    # strangely, Ireland is missing from the data, using it's census data to fill the gaps.
+    population_overrides = pd.concat([ovr.load_overrides("dose"),ovr.ireland_census()],ignore_index=True)
 
+    # one join on (gid_1 or country and region, year) for all the years
+    dose_year, pop_report = ovr.apply_overrides(dose_year,population_overrides,"pop")
 
-# yeahhhh
-dose_year.loc[missing_pop.index,"pop"] = missing_pop["pop"]
+    print("Populations filled : ",pop_report.shape[0])
+    print("Regions still without population : ",dose_year["pop"].isna().sum())
+    # overrides matching no region, e.g. a renamed region in a new DOSE version
+    print("Unused overrides : ",ovr.unused_overrides(population_overrides,pop_report,"pop").region.tolist())
 
+    # ## Converting to absolute GDP values
+    # Computing grp values in usd_2015.
+    for sector, pc in [("agriculture","ag_grp_pc"),("manufacturing","man_grp_pc"),("services","serv_grp_pc"),("grp","grp_pc")]:
+        dose_year[f"{sector}_usd_2015"] = dose_year[f"{pc}_usd_2015"]*dose_year["pop"]
 
-# In[93]:
-
-
-# resetting back the index.
-dose_year.reset_index(inplace=True,drop=False)
-
-
-# ## Converting to absolute GDP values
-# Computing grp values in usd_2015.
-
-# In[94]:
-
-
-# USD
-
-dose_year["agriculture_usd_2015"] = dose_year["ag_grp_pc_usd_2015"]*dose_year["pop"]
-dose_year["manufacturing_usd_2015"] = dose_year["man_grp_pc_usd_2015"]*dose_year["pop"]
-dose_year["services_usd_2015"] = dose_year["serv_grp_pc_usd_2015"]*dose_year["pop"]
-dose_year["grp_usd_2015"] = dose_year["grp_pc_usd_2015"]*dose_year["pop"]
-
-# LCU
-# 
-# dose_year["agriculture_lcu_2015"] = dose_year["ag_grp_pc_lcu_2015"]*dose_year["pop"]
-# dose_year["manufacturing_lcu_2015"] = dose_year["man_grp_pc_lcu_2015"]*dose_year["pop"]
-# dose_year["services_lcu_2015"] = dose_year["serv_grp_pc_lcu_2015"]*dose_year["pop"]
-# dose_year["grp_lcu_2015"] = dose_year["grp_pc_lcu_2015"]*dose_year["pop"]
-
-
-# ### missing values from lcu and usd
-
-# ### Do things add up ? 
-# 
-
-# ### Data sets light
-
-# In[101]:
-
-
-# the light version is reduced to the variables of interest only. This includes a specific year, sector and total gdp(grp) values.
-dose_light = dose_year[["country","gid_0","gid_1","grp_usd_2015","services_usd_2015","manufacturing_usd_2015","agriculture_usd_2015"]].copy()
-
-
-# In[102]:
-
-
-wdi_df_var.dropna(subset=["grp_usd_2015"],inplace=True)
-
-
-# In[103]:
-
-
-# WDI is also reduced to the essential in order to concat the data sets later on.
-# this step could be done at an earlier stage as well to avoid redundancy.
-wdi_country_simple = wdi_df_var.loc[:,~wdi_df_var.columns.isin(["gdp_cap"])]
-
-
-# ## [Combining](#combining)
-# Using the fact that columns are named the same.
-
-# #### The column names should match
-
-# ### Do things add up at this point ?
-
-# In[107]:
-
-
-# NO THEY DONT !!
-
-
-# In[108]:
-
-
-wdi_country_simple = (wdi_country_simple.assign(gid_0=wdi_country_simple["country_code"]
-                                                ,gid_1=wdi_country_simple["country_code"])
-                                                .drop(columns=["country_code"]))
-
-
-# In[109]:
-
-
-if wdi_country_simple.columns.difference(dose_light.columns).__len__()!=0:
-    raise Exception("Some columns don't match in the data sets, concatenation behaviour will be unexpected.")
+    return dose_year
 
 
 # ### filling admin 1 gaps in dose with WDI
@@ -839,309 +261,205 @@ if wdi_country_simple.columns.difference(dose_light.columns).__len__()!=0:
 # The process : 
 # when a country in DOSE has missing sectorial values, take the proportion of per sector gdp in WDI for the national scale and replace in DOSE.
 
-# In[111]:
-
-
-incomplete_dose = list(dose_light.loc[dose_light[["services_usd_2015","manufacturing_usd_2015","agriculture_usd_2015","grp_usd_2015"]].isna().any(axis=1),"gid_0"].unique())
-
-
-# In[112]:
-
-
-# get the data of interest into a pandas df
-# wdi_df_full contains the same countries as the original dose
-wdi_df_full = (wdi_of_interest
-               .filter(~_.country_code.isin(missing_regions),_.country_code.isin(dose_countries))
-               .to_pandas()
-               .pivot(columns=["indicator_name",],values=[str(year)],index=["country_name","country_code"]).reset_index())
-
-wdi_df_full.rename(columns={v:k for (k,v) in indicators_of_intereset.items()} # inverting the indicators of interest to rename columns
-                  ,inplace=True)
-wdi_df_full.columns = [x[1] if x[1]!='' else x[0] for x in wdi_df_full.columns]
-wdi_df_full.columns = [x.replace("industry", "manufacturing") if re.search(string=x,pattern="industry_") else x for x in wdi_df_full.columns]
-
-
-# In[114]:
-
-
-# This data frame name is a bit confusing, but it contains WDI data missing from dose.
-dose_missing_df = wdi_df_full.loc[wdi_df_full.country_code.isin(incomplete_dose)].copy()
-
-
-# In[115]:
-
-
-# should not be empty
-print("Any value missing: ",dose_missing_df.isna().any().any())
-
-
-# In[117]:
-
+def dose_light_stage(dose_year: pd.DataFrame, wdi_df_full: pd.DataFrame) -> pd.DataFrame:
+    """DOSE reduced to the variables of interest, the missing sectors from the WDI sector fractions of the country."""
+    # the light version is reduced to the variables of interest only. This includes a specific year, sector and total gdp(grp) values.
+    dose_light = dose_year[["country","gid_0","gid_1","year",*sector_columns]].copy()
 
-dose_missing_df.reset_index(inplace=True,drop=True)
+    incomplete_dose = list(dose_light.loc[dose_light[sector_columns].isna().any(axis=1),"gid_0"].unique())
 
+    # This data frame name is a bit confusing, but it contains WDI data missing from dose.
+    dose_missing_df = wdi_df_full.loc[wdi_df_full.country_code.isin(incomplete_dose)].reset_index(drop=True)
+    # should not be empty
+    print("Any value missing: ",dose_missing_df.isna().any().any())
 
-# In[118]:
+    # computing fractions of GDP per sector from WDI
+    for sector in gf.sectors:
+        dose_missing_df[f"{sector}_frac"] = dose_missing_df[f"{sector}_usd_2015"]/dose_missing_df["grp_usd_2015"]
 
+    # To avoid mixing up WDI, first fill in gaps from dose regions with WDI fracions of GDP per sector for industies
+    # Then combine with the missing regions/countries
+    dose_light = dose_light.merge(dose_missing_df.filter(regex="(_frac)|(country_code)|(^year$)"),left_on=["gid_0","year"],right_on=["country_code","year"],how="left")
 
-# computing fractions of GDP per sector from WDI
+    for sector in gf.sectors:
+        missing = dose_light[f"{sector}_usd_2015"].isna()
+        dose_light.loc[missing,f"{sector}_usd_2015"] = dose_light.loc[missing,f"{sector}_frac"]*dose_light.loc[missing,"grp_usd_2015"]
 
-dose_missing_df["services_frac"] = dose_missing_df["services_usd_2015"]/dose_missing_df["grp_usd_2015"]
-dose_missing_df["manufacturing_frac"] = (dose_missing_df["manufacturing_usd_2015"]/dose_missing_df["grp_usd_2015"])
-dose_missing_df["agriculture_frac"] = dose_missing_df["agriculture_usd_2015"]/dose_missing_df["grp_usd_2015"]
-
-# dose_missing_df["industry_frac"] = dose_missing_df["industry_usd_2015"]/dose_missing_df["grp_usd_2015"]
-
-
-# To avoid mixing up WDI, first fill in gaps from dose regions with WDI fracions of GDP per sector for industies
-# 
-# Then combine with the missing regions/countries
-
-# In[121]:
-
-
-# dose_missing_df.filter(regex="(_frac)|(country_code)")
-dose_light = dose_light.merge(dose_missing_df.filter(regex="(_frac)|(country_code)"),left_on="gid_0",right_on="country_code",how="left",suffixes=["_dose","_wdi"])
-
-
-# In[123]:
-
-
-# dose_light[dose_light.country=="Laos"]
-
-
-# In[124]:
-
-
-missing_agriculture = dose_light[dose_light["agriculture_usd_2015"].isna()].index
-missing_services = dose_light[dose_light["services_usd_2015"].isna()].index
-missing_manufacturing = dose_light[dose_light["manufacturing_usd_2015"].isna()].index
-
-missing_grp = dose_light[dose_light["grp_usd_2015"].isna()].index
-
-
-# In[125]:
-
-
-dose_light.loc[missing_agriculture,"agriculture_usd_2015"] = dose_light.loc[missing_agriculture,"agriculture_frac"]*dose_light.loc[missing_agriculture,"grp_usd_2015"]
-
-dose_light.loc[missing_manufacturing,"manufacturing_usd_2015"] = dose_light.loc[missing_manufacturing,"manufacturing_frac"]*dose_light.loc[missing_manufacturing,"grp_usd_2015"]
-
-dose_light.loc[missing_services,"services_usd_2015"] = dose_light.loc[missing_services,"services_frac"]*dose_light.loc[missing_services,"grp_usd_2015"]
-
-# dose_light.loc[missing_grp,"grp_usd_2015"] = dose_light.loc[missing_services,"grp_usd_2015_"]
-
-
-# In[127]:
-
-
-dose_light = dose_light.drop(columns=["country_code",*[x for x in dose_light.columns if re.search(string = x,pattern="(_frac)|(_2015_wdi)")]])
-
-
-# In[130]:
-
-
-# dose_light[dose_light.country=="Colombia"]
-
-
-# ### Now combine the WDI data with filled missing regional gdp with missing countries from WDI.
-
-# In[133]:
-
-
-dose_light_combined = pd.concat([dose_light,wdi_country_simple],axis=0).reset_index(drop=True)
-
-
-# In[137]:
-
-
-print("Data to this point: ",dose_light_combined.shape)
-print("Full row of NAs removed: ", dose_light_combined.dropna(axis=0,how="all").shape)
-print("Some missing economic indicator removed: ", dose_light_combined.dropna(subset=["grp_usd_2015","services_usd_2015","manufacturing_usd_2015","agriculture_usd_2015"],axis=0,how="any").shape)
-
-
-# ## [Complementary filling](#comp_fill)
-# 
-# We have GDP = agriculture + manufacturing + services. If any single value of the rhs is missing, we can find it. If lhs is missing, we can sum rhs.
-# 
-# next, a function will check this. 
-
-# In[139]:
-
-
-# function to find the missing values in rows and fill them if possible
-def check_and_fill_row(row: pd.Series):
-    lhs = [x for x in row.index.tolist() if re.search(string=x, pattern="(gdp)|(grp)")]
-    rhs = [x for x in row.index.tolist() if re.search(string=x, pattern="(manufacturing)|(services)|(agriculture)")]
-
-    if row[lhs].isna().item() and (not row[rhs].isna().any().item()):
-        row[lhs]=row[rhs].sum()
-    
-    elif (not row[lhs].isna().item()) and row[rhs].isna().sum()==1:
-        which = row[rhs].isna()[row[rhs].isna()].index.tolist()
-        # assign to the missing values in the rhs, the value of the lhs minus the values of the other rhs variables.
-        row[which] = row[lhs]-row[[x for x in rhs if x not in which]].sum()
-    else:
-        pass
-
-    return row
-
-
-# In[140]:
-
-
-dose_light_combined[dose_light_combined.isna().any(axis=1)] = dose_light_combined[dose_light_combined.isna().any(axis=1)].apply(check_and_fill_row,axis=1)
-
-
-# In[141]:
-
-
-print("Data to this point: ",dose_light_combined.shape)
-print("Full row of NAs removed: ", dose_light_combined.dropna(axis=0,how="all").shape)
-print("Some missing economic indicator removed: ", dose_light_combined.dropna(subset=["grp_usd_2015","services_usd_2015","manufacturing_usd_2015","agriculture_usd_2015"],axis=0,how="any").shape)
-
-
-# In[143]:
-
-
-# writing back the modified data set into the original one. this can be avoided and all the operations can be done on the original one right away once the workflow is good. 
-dose_light_combined.dropna(subset=["grp_usd_2015","services_usd_2015","manufacturing_usd_2015","agriculture_usd_2015"],axis=0,how="all",inplace=True)
-dose_light_combined.reset_index(inplace=True,drop=True)
+    return dose_light.drop(columns=["country_code",*[x for x in dose_light.columns if re.search(string = x,pattern="(_frac)")]])
 
 
 # ## [Countries with missing regions](#partial_miss)
 # 
-# In some cases, not all the regions in a country covered by DOSE are provided. This case has not been treated yet. The process here is to distribute the remainder of gdp across the 3 sectors uniformly to the missing regions. This is again a first order approximation. And whenever better data is obtained can be ameliorated.
-# We rely on the table computed earlier containing incomplete country regions. 
-# 
-
-# In[146]:
-
-
-dose_missing_regions
-
-
-# In[147]:
-
-
-incomplete_countries = dose_missing_regions.country.unique()
-incomplete_countries
-
-
-# In[148]:
-
-
-wdi_incomplete = wdi_df_full[wdi_df_full.country_code.isin(incomplete_countries)].groupby("country_code").sum(numeric_only=True)
-
-
-# In[149]:
-
-
-wdi_incomplete.head()
-
-
-# In[150]:
-
-
-dose_incomplete = dose_light_combined[dose_light_combined.gid_0.isin(incomplete_countries)].assign(count=1).groupby("gid_0").sum(numeric_only=True)
-
-
-# In[151]:
-
-
-dose_incomplete.head()
-
-
-# In[152]:
-
+# In some cases, not all the regions in a country covered by DOSE are provided. The process here is to distribute the remainder of gdp across the 3 sectors to the missing regions, uniformly or by weight ('allocation_weights'). This is again a first order approximation. And whenever better data is obtained can be ameliorated.
 
-incomplete_values = (wdi_incomplete - dose_incomplete)
+def region_weights(boundaries: ib.Table, weights: str = allocation_weights) -> pd.DataFrame:
+    """Weights of the regions in the allocation, None for uniform."""
+    if weights == "uniform":
+        return None
+    if weights == "area":
+        # equal area projection to compare the regions
+        return boundaries.alias("b").sql("""SELECT gid_1, sum(ST_Area(ST_Transform(geometry, 'EPSG:4326', 'ESRI:54009', always_xy := true))) as weight 
+                                         FROM b GROUP BY gid_1;""").to_pandas()
 
+    return pd.read_csv(weights)
 
-# In[153]:
 
+def dose_light_combined_stage(dose_light: pd.DataFrame, wdi_df_var: pd.DataFrame, wdi_df_full: pd.DataFrame,
+                              incomplete_country_years: pd.DataFrame, incomplete_missing_regions: pd.DataFrame, weights: pd.DataFrame = None) -> pd.DataFrame:
+    """DOSE, the countries missing from DOSE from WDI and the regions missing from the incomplete countries."""
+    # WDI is also reduced to the essential in order to concat the data sets later on.
+    wdi_country_simple = wdi_df_var.dropna(subset=["grp_usd_2015"])
+    wdi_country_simple = wdi_country_simple.loc[:,~wdi_country_simple.columns.isin(["gdp_cap"])]
+    wdi_country_simple = (wdi_country_simple.assign(gid_0=wdi_country_simple["country_code"]
+                                                    ,gid_1=wdi_country_simple["country_code"])
+                                                    .drop(columns=["country_code"]))
 
-incomplete_values.drop(columns=["count","gdp_cap"],inplace=True)
+    if wdi_country_simple.columns.difference(dose_light.columns).__len__()!=0:
+        raise Exception("Some columns don't match in the data sets, concatenation behaviour will be unexpected.")
 
+    # ## [Combining](#combining)
+    # Using the fact that columns are named the same.
+    dose_light_combined = pd.concat([dose_light,wdi_country_simple],axis=0).reset_index(drop=True)
 
-# In[154]:
+    print("Data to this point: ",dose_light_combined.shape)
+    print("Full row of NAs removed: ", dose_light_combined.dropna(axis=0,how="all").shape)
+    print("Some missing economic indicator removed: ", dose_light_combined.dropna(subset=sector_columns,axis=0,how="any").shape)
 
+    # ## [Complementary filling](#comp_fill)
+    # We have GDP = agriculture + manufacturing + services. If any single value of the rhs is missing, we can find it. If lhs is missing, we can sum rhs.
+    # the identity is declared in gap_filling.py and applied on whole columns.
+    dose_light_combined, fill_report = gf.fill_identity(dose_light_combined,gf.sector_identity("usd_2015"))
+    print(fill_report)
 
-incomplete_values
+    dose_light_combined.dropna(subset=sector_columns,axis=0,how="all",inplace=True)
+    dose_light_combined.reset_index(inplace=True,drop=True)
 
+    # ## [Partially missing regions](#partial_miss)
+    # national values of the incomplete countries for each year, the residual is what the DOSE regions do not cover
+    wdi_incomplete = (wdi_df_full
+                      .merge(incomplete_country_years,left_on=["country_code","year"],right_on=["gid_0","year"])
+                      [["gid_0","year",*sector_columns]])
 
-# In[155]:
+    incomplete_values = gf.residuals(wdi_incomplete,dose_light_combined,gf.sector_identity("usd_2015"))
 
+    # all the countries and years at once
+    dose_allocated = gf.allocate_residuals(incomplete_values,incomplete_missing_regions,sector_columns,weights=weights)
 
-incomplete_values.grp_usd_2015.hist()
-plt.show()
+    # the residuals satisfy the identity, so do their shares
+    allocation_errors = gf.identity_errors(dose_allocated,gf.sector_identity("usd_2015"))
+    if len(allocation_errors) > 0:
+        raise ValueError(f"Allocated regions where the GRP is not the sum of the sectors :\n{allocation_errors}")
 
+    # the allocated regions are added with the country name of the other regions
+    country_names = dose_light_combined[["gid_0","country"]].drop_duplicates("gid_0")
 
-# In[156]:
+    dose_light_combined = pd.concat([dose_light_combined,
+                                     dose_allocated.drop(columns="share").merge(country_names,on="gid_0",how="left")],
+                                    axis=0).reset_index(drop=True)
 
+    print("Regions allocated : ",dose_allocated.shape[0])
+    print("Data to this point: ",dose_light_combined.shape)
 
-incomplete_values.manufacturing_usd_2015.hist()
-plt.show()
+    return dose_light_combined
 
 
-# In[157]:
-
-
-incomplete_values.services_usd_2015.hist()
-plt.show()
-
-
-# In[158]:
-
-
-incomplete_values.agriculture_usd_2015.hist()
-plt.show()
-
-
-# ## Validations
-# Running some tests on the data to identify problems
-
 # ## Saving the combined file.
 
-# In[170]:
-
-
-import os
-
-version = "0_4"
-
-dir_name = f"../datasets/local_data/dose-wdi/"
-
-filename_dose_light = f"{dir_name}{version}/dose_light_combined_{year}_{version}.csv"
-filename_dose_light
+def save(conn: ib.backends.duckdb.Backend, dose_light_arrow: pa.Table, run_years: list, version: str = version) -> str:
+    """Write the years of the combined data set as typed parquet, years already written are left as they are."""
+    filename_dose_light = dose_light_filename(version)
 
+    if not os.path.exists(f"{dose_wdi_path}{version}"):
+        os.makedirs(f"{dose_wdi_path}{version}")
 
-# In[171]:
-
-
-if not os.path.exists(f"{dir_name}{version}"):
-    os.mkdir(f"{dir_name}{version}")
-
-if os.path.exists(filename_dose_light):
-    print(Warning("File already exists, erase before if you want to regenerate, or update version"))
-
-else: 
-    print(f"Writing file locally to '{filename_dose_light}'.")
-    dose_light_combined.to_csv(filename_dose_light,index=False)
-
-
-# ### Reading the local file
-
-# ### Checking if things add up
-
-# ## H3 with duckdb
-# 
-# testing the duckdb h3 extension to potentially transfer all the projection on the db side for better performance.
-
-# In[183]:
-
-
-conn.sql("SELECT h3_cell_to_latlng('822d57fffffffff');")
-
-conn.sql("SELECT h3_cell_to_boundary_wkt('822d57fffffffff');")
+    existing_years = [x for x in run_years if os.path.exists(f"{filename_dose_light}/year={x}")]
 
+    if len(existing_years) > 0:
+        print(Warning(f"Years {existing_years} already exist, erase before if you want to regenerate, or update version"))
+    else:
+        print(f"Writing years {run_years} locally to '{filename_dose_light}'.")
+        dwi.write_dose_wdi(conn,dose_light_arrow,filename_dose_light)
+
+    return filename_dose_light
+
+
+def main(years: list = years, version: str = version, conn: ib.backends.duckdb.Backend = None) -> pa.Table:
+    """Run the gap filling for 'years' and write the combined data set. Each stage is memoised by stage_cache.py, a rerun
+    only recomputes the stages whose inputs changed. The combined table is also published for missing_countries_geo.py.
+    """
+    conn = conn or sn_connect(interactive=False)
+
+    # typed, read from the year partitioned parquet cache of the csv (written on first use), '#N/A' are nulls.
+    # all the 'years' are processed together, the year is a key column in every table below.
+    dose = ecd.read_dose(conn,years=years).rename("snake_case")
+    boundaries = load_boundaries(conn)
+
+    coverage_df, coverage_key = sc.stage("coverage",coverage_stage,
+                                         inputs=[ecd.dose_file,bc.boundary_cache_file],
+                                         params={"years" : years},
+                                         code=[cov],
+                                         kwargs={"boundaries" : boundaries, "dose" : dose, "years" : years})
+
+    countries = country_coverage(coverage_df,dose,years)
+    run_years = countries["run_years"]
+    print("Incomplete countries : ",len(countries["incomplete_countries"]))
+    print("Missing countries : ",len(countries["missing_countries"]))
+
+    check_wdi_years(conn,run_years)
+
+    wdi_df_var, wdi_df_var_key = sc.stage("wdi_df_var",wdi_df_var_stage,
+                                          inputs=[ecd.wdi_file,ovr.overrides_file],
+                                          params={"years" : run_years, "countries" : sc.frame_hash(countries["missing_country_years"]), "indicators" : indicators_of_intereset},
+                                          code=[wdi_table,wdi_names,ecd,ovr],
+                                          kwargs={"conn" : conn, "run_years" : run_years, "missing_countries" : countries["missing_countries"],
+                                                  "missing_country_years" : countries["missing_country_years"]})
+
+    dose_year, dose_year_key = sc.stage("dose_year",dose_year_stage,
+                                        inputs=[ecd.dose_file,ovr.overrides_file,ovr.ireland_census_file],
+                                        params={"years" : run_years, "gdp_thres" : gdp_thres},
+                                        code=[inconsistencies,ecd,ovr],
+                                        kwargs={"dose" : dose})
+
+    wdi_df_full, wdi_df_full_key = sc.stage("wdi_df_full",wdi_df_full_stage,
+                                            inputs=[ecd.wdi_file],
+                                            params={"years" : run_years, "countries" : countries["dose_countries"], "indicators" : indicators_of_intereset},
+                                            code=[wdi_table,wdi_names,ecd],
+                                            upstream=[coverage_key],
+                                            kwargs={"conn" : conn, "run_years" : run_years, "dose_countries" : countries["dose_countries"],
+                                                    "missing_regions" : countries["missing_regions"]})
+
+    dose_light, dose_light_key = sc.stage("dose_light",dose_light_stage,
+                                          code=[gf],
+                                          upstream=[dose_year_key,wdi_df_full_key],
+                                          kwargs={"dose_year" : dose_year, "wdi_df_full" : wdi_df_full})
+
+    # uniform shares without weights, the area weights cover every region of the boundaries
+    weights, weights_key = None, None
+    if allocation_weights != "uniform":
+        weights, weights_key = sc.stage("region_weights",region_weights,
+                                        inputs=[bc.boundary_cache_file] if allocation_weights == "area" else [allocation_weights],
+                                        params={"allocation_weights" : allocation_weights},
+                                        kwargs={"boundaries" : boundaries, "weights" : allocation_weights})
+
+    dose_light_combined, dose_light_combined_key = sc.stage("dose_light_combined",dose_light_combined_stage,
+                                                            inputs=[ecd.wdi_file],
+                                                            params={"missing_regions" : sc.frame_hash(countries["incomplete_missing_regions"]),
+                                                                    "incomplete_countries" : sc.frame_hash(countries["incomplete_country_years"]),
+                                                                    "allocation_weights" : allocation_weights},
+                                                            code=[gf],
+                                                            upstream=[wdi_df_var_key,dose_light_key,wdi_df_full_key,weights_key],
+                                                            kwargs={"dose_light" : dose_light, "wdi_df_var" : wdi_df_var, "wdi_df_full" : wdi_df_full,
+                                                                    "incomplete_country_years" : countries["incomplete_country_years"],
+                                                                    "incomplete_missing_regions" : countries["incomplete_missing_regions"],
+                                                                    "weights" : weights})
+
+    # typed parquet, and the Arrow table for the geo stage when it runs in the same process (dose_wdi.py)
+    dose_light_arrow = dwi.to_arrow(dose_light_combined)
+    dwi.publish(dose_light_arrow)
+    save(conn,dose_light_arrow,run_years,version)
+
+    return dose_light_arrow
+
+
+if __name__ == "__main__":
+    main()
@@ -30,7 +30,11 @@ ib.options.interactive = True
 import scalenav.oop as snoo
 from scalenav.plotting import cmap
 
-from parameters import year
+from parameters import year,version,dose_wdi_path
+import dose_wdi as dwi
+import boundary_cache as bc
+import dissolve as dis
+import admin_keys as ak
 
 # plots
 from datashader import transfer_functions as tf, reductions as rd
@@ -43,115 +47,21 @@ from matplotlib import pyplot as plt
 # In[2]:
 
 
-# ddb.connect()
-conn = snoo.sn_connect()
-conn.list_tables() # empty
-
-
-# In[3]:
-
-
-# the merged file
-
-#local path with folder where the downloaded shapefiles are stored 
-#(both GADM and the custom one)
-
-gadm_path = '../datasets/DOSE/V2/DOSE_replication_files/DOSE_replication_files/Data/spatial data/' # ../../../../../
-
-# Read shapefiles
-
-file_name = "gadm36_1"
-
-
-# In[4]:
-
-
-#Export merged geodataframe into shapefile
-
+# the merged GADM 3.6 and custom DOSE regions, built once as GeoParquet with simplified geometry levels (boundary_cache.py)
+# the full geometry is kept for the exported data set
 out_path = "../datasets/DOSE/V2/" # ../../../../../
 
-dose_spatial_file = f"{out_path}{file_name}_custom_merged.parquet"
-
-if not os.path.exists(dose_spatial_file):
-    print("reading existing file")
-    gadm = gpd.read_file(gadm_path+"gadm36_levels_shp/" + file_name+".shp")
-    # has to be downloaded from https://gadm.org/download_world36.html; follow instructions in readme
-
-    custom = gpd.read_file(gadm_path+'all_non_GADM_regions.shp')
-
-    #list of GADM countries whose data is not needed because we provide it with the custom file
-    unneeded_list = ["KAZ","MKD","NPL","PHL","LKA"]
-
-    #remove geometry for these countries from GADM
-    gadm_trim = gadm[~gadm.GID_0.isin(unneeded_list)]
-
-    # Merge/Combine multiple shapefiles into one
-    gadm_custom = gpd.pd.concat([gadm_trim, custom])
-    gadm_custom.drop(columns="fid",inplace=True)
-
-    gadm_custom.to_parquet(dose_spatial_file)
-
-
-# eventually can be done with gadm4.1
-# gpd.list_layers(gadm_path+"gadm_410-levels.gpkg")
-# adm1 = gpd.read_file("../datasets/DOSE/DOSE_replication_files/DOSE_replication_files/Data/spatial data/gadm_410-levels.gpkg",layer="ADM_1")
-
-
-# In[5]:
-
-
-geoboundaries_file = '"../datasets/boundaries/GeoBoundaries/geoBoundariesCGAZ_ADM1.gpkg"'
-gadm_file =  '"../datasets/boundaries/GADM/gadm_410.gpkg"'
-
-conn.raw_sql(f"""CREATE OR REPLACE TABLE boundaries AS SELECT * FROM '{dose_spatial_file}';""")
-
-
-# In[6]:
-
-
-# link the table from the duckdb, this is not performed by the previous operation
-boundaries = conn.table("boundaries")
-# boundaries
-
-
-# In[7]:
+# eventually can be done with gadm4.1 or geoBoundaries, converted once with the same columns (boundary_providers.py)
+# adm1 = boundary_providers.read_provider(conn, "gadm41")
 
+gadm_gid_0_filename = f"{out_path}gadm_gid_0.parquet"
 
 # wb_countries = gpd.read_file("datasets/boundaries/WB_countries_Admin0_10m/WB_countries_Admin0_10m.shp")
 
 
-# ### Reading the local dose-WDI data set
-# 
-
-# In[8]:
-
-
-dose_wdi_path = "../datasets/local_data/dose-wdi/"
-# latest
-# version = "0_3"
-from missing_countries import version
-
-dose_light = conn.read_csv(source_list=f"{dose_wdi_path}{version}/dose_light_combined_{year}_{version}.csv",table_name="dose_light")
-
-
-# ### Preparing the data
-
-# In[9]:
-
-
-# nice function from ibis
-boundaries = boundaries.rename("snake_case")
-dose_light = dose_light.rename("snake_case")
-
-
-# In[10]:
-
-
-boundary_countries = conn.sql("Select distinct(gid_1) from boundaries;").to_pandas().iloc[:,0].to_list()
-len(boundary_countries)
-
-
-# In[12]:
+def dose_wdi_geo_filename(version: str = version) -> str:
+    """GeoParquet export of the dose-wdi data set with its geometries."""
+    return f"../datasets/local_data/dose-wdi/{version}/dose_wdi_geo_{version}.parquet"
 
 
 def head_rand(conn: ib.backends.duckdb.Backend, table: str, limit:[int,str]=5):
@@ -161,186 +71,133 @@ def head_rand(conn: ib.backends.duckdb.Backend, table: str, limit:[int,str]=5):
     return conn.sql(query=query)
 
 
-# In[15]:
-
-
-# subsetting the boundaries data:
-boundary_columns = ["GID_0","NAME_0","GID_1","NAME_1","geometry"]
-boundary_columns = [str(x).lower() for x in boundary_columns]
-
-boundaries = boundaries.select(boundary_columns)
-
-
-# In[18]:
-
-
-boundaries_1 = conn.sql("""select * EXCLUDE (geometry)
-                        , ST_Centroid(geometry::GEOMETRY) as centr
-                        , geometry::GEOMETRY as geometry 
-                        from boundaries;""")
-
-
-# ### Working only on centroids
-
-# In[21]:
-
-
-boundaries_centr = boundaries_1.rename("snake_case").execute()
-
-
-# In[22]:
-
+# In[5]:
 
-# regions to merge with DOSE
 
-boundaries_1_centr = boundaries_centr.dissolve("gid_1")
-boundaries_1_centr["centr"] = boundaries_1_centr.geometry.centroid
-# 
-# boundaries_1_centr.drop(columns="geom",inplace=True)
-boundaries_1_centr.reset_index(inplace=True,drop=False)
-# 
-boundaries_1_centr = boundaries_1_centr.astype({"gid_1":str})
+def load_boundaries(conn: ib.backends.duckdb.Backend) -> ib.Table:
+    """The regions with their full geometry, as the 'boundaries' table of the data base."""
+    conn.create_table("boundaries",obj=bc.read_boundaries(conn,level="full"),overwrite=True)
 
-# boundaries_1_centr.dtypes
+    # link the table from the duckdb, this is not performed by the previous operation
+    boundaries = conn.table("boundaries")
 
+    # nice function from ibis
+    boundaries = boundaries.rename("snake_case")
 
-# In[23]:
+    # subsetting the boundaries data:
+    boundary_columns = ["GID_0","NAME_0","GID_1","NAME_1","geometry"]
+    boundary_columns = [str(x).lower() for x in boundary_columns]
 
-
-gadm_gid_0_filename = f"{out_path}gadm_gid_0.parquet"
+    return boundaries.select(boundary_columns)
 
 
 # In[24]:
 
 
-if not os.path.exists(gadm_gid_0_filename):
-    boundaries_0_centr = conn.sql(
-    """SELECT 
-            gid_0, 
-            ST_Union_Agg(geometry) as geometry 
-            from 
-                (select * EXCLUDE (geometry)
-                            , ST_Centroid(geometry::GEOMETRY) as centr
-                            , geometry::GEOMETRY as geometry 
-                            from boundaries) 
-            GROUP BY gid_0;""").execute() # boundaries_1
-    
-    boundaries_0_centr.set_crs(epsg=4326,inplace=True)
-    boundaries_0_centr.to_parquet(gadm_gid_0_filename)
-
-
-# In[25]:
+def build_countries(conn: ib.backends.duckdb.Backend, filename: str = gadm_gid_0_filename) -> str:
+    """The countries, built once : one union per country in a process pool, the largest countries first (dissolve.py).
+    The workers re-import this file when they are spawned, the pool is only started from main().
+    """
+    if not os.path.exists(filename):
+        boundaries_0 = conn.sql("select gid_0, geometry::GEOMETRY as geometry from boundaries;").execute()
+        boundaries_0 = boundaries_0.set_crs(epsg=4326,allow_override=True)
 
+        dis.dissolve(boundaries_0,"gid_0").to_parquet(filename)
 
-boundaries_0_centr = gpd.read_parquet(gadm_gid_0_filename)
+    return filename
 
 
-# In[26]:
-
-
-boundaries_0_centr.columns = [x.lower() for x in boundaries_0_centr.columns]
-
-
-# In[27]:
-
-
-# boundaries_0_centr = boundaries_centr[["gid_0","geometry"]].set_geometry("geometry").set_crs(epsg=4326).dissolve(by="gid_0")
-boundaries_0_centr["centr"] = boundaries_0_centr.geometry.centroid
-# 
-# boundaries_0_centr.drop(columns="geom",inplace=True)
-boundaries_0_centr.reset_index(inplace=True,drop=False)
+# ### Attaching the geometries and centroids
 # 
-boundaries_0_centr = boundaries_0_centr.astype({"gid_0":str})
-# boundaries_0_centr.dtypes
-
-
-# In[29]:
-
-
-dose_light_geo_ = dose_light.execute()
-
-
-# In[30]:
-
-
-dose_light_geo_ = dose_light_geo_.astype({"gid_1" : str})
-
-
-# In[31]:
-
-
-dose_light_geo_[dose_light_geo_.gid_1=="LAO"]
-
-
-# In[33]:
-
-
-# boundaries_1_centr.dtypes
-
+# in a single query, the polygons stay in duckdb :
+#     - the regions with several polygons are collected into one multi polygon, without union
+#     - the rows without region in the boundaries, the countries from WDI, take the geometry of their country
+#     - the centroid and its coordinates
 
 # In[32]:
 
 
-dose_light_geo = gpd.GeoDataFrame(dose_light_geo_.merge(boundaries_1_centr[["gid_1","centr","geometry"]],on="gid_1",how="left"))
+def attach_geometries(dose_light: ib.Table, countries_filename: str = gadm_gid_0_filename) -> ib.Table:
+    """The dose-wdi rows with the geometry of their region, or of their country, and its centroid."""
+    return dose_light.alias("dose_light").sql(f"""
+    WITH adm1 AS (
+        SELECT gid_1, 
+            CASE WHEN count(*) = 1 THEN any_value(geometry::GEOMETRY) ELSE ST_Collect(list(geometry::GEOMETRY)) END as geometry
+        FROM boundaries 
+        GROUP BY gid_1
+    ),
+    adm0 AS (
+        SELECT gid_0, geometry::GEOMETRY as geometry FROM read_parquet('{countries_filename}')
+    ),
+    attached AS (
+        SELECT d.*, coalesce(adm1.geometry, adm0.geometry) as geometry
+        FROM dose_light d
+            LEFT JOIN adm1 ON d.gid_1 = adm1.gid_1
+            LEFT JOIN adm0 ON adm1.gid_1 IS NULL AND d.gid_0 = adm0.gid_0
+    )
+    SELECT *, ST_Centroid(geometry) as centr, ST_X(ST_Centroid(geometry)) as x, ST_Y(ST_Centroid(geometry)) as y
+    FROM attached;
+    """)
 
 
 # In[34]:
 
 
-missing_geoms = dose_light_geo.centr.isna()
-
-
-# In[36]:
-
-
-missing_countries = dose_light_geo_.loc[missing_geoms,"gid_0"].to_list()
+def unresolved_keys(conn: ib.backends.duckdb.Backend, dose_light: ib.Table) -> pd.DataFrame:
+    """Keys of dose-wdi with neither a region nor a country in the boundaries (admin_keys.py).
+    Only the ids and names are read, the same gid_1 then gid_0 fallback as 'attach_geometries'.
+    """
+    admin_index = ak.key_index({
+        "gid_1" : conn.sql("SELECT gid_1, any_value(name_1) as name FROM boundaries GROUP BY gid_1;").to_pandas(),
+        "gid_0" : conn.sql("SELECT gid_0, any_value(name_0) as name FROM boundaries GROUP BY gid_0;").to_pandas(),
+    })
 
+    dose_light_keys, unresolved = ak.resolve(dose_light.select("gid_0","gid_1").to_pandas(),admin_index)
+    print(dose_light_keys.admin_level.value_counts(dropna=False))
 
-# In[ ]:
+    return unresolved
 
 
-boundaries_0_centr_missing = boundaries_0_centr[boundaries_0_centr.gid_0.isin(missing_countries)].set_index("gid_0")
-dose_light_geo.set_index("gid_0",inplace=True)
-
-
-# In[42]:
-
-
-dose_light_geo.loc[missing_countries,["centr","geometry"]] = boundaries_0_centr_missing[["centr","geometry"]]
-dose_light_geo.reset_index(inplace=True,drop=False)
-
-
-# In[43]:
+# ### Exporting
 
+# In[52]:
 
-# dose_light_geo.set_geometry("geometry",inplace=True).set_crs(epsg=4326,inplace=True)
-# dose_light_geo.set_crs(epsg=4326,inplace=True)
 
-dose_light_geo.set_geometry("centr",inplace=True)
-dose_light_geo.set_crs(epsg=4326,inplace=True)
+def export(conn: ib.backends.duckdb.Backend, dose_light_geo: ib.Table, version: str = version) -> str:
+    """Written from duckdb as GeoParquet, geometry and centr are geometry columns."""
+    filename = dose_wdi_geo_filename(version)
 
+    if not os.path.exists(filename):
+        conn.to_parquet(dose_light_geo,filename)
+    else :
+        raise Warning(f"File already exists at '{filename}'.")
 
-# ### Exporting
+    return filename
 
-# In[44]:
 
+def main(year: int = year, version: str = version, conn: ib.backends.duckdb.Backend = None) -> ib.Table:
+    """Attach the geometries to the dose-wdi data set of 'year' and export it.
+    To pass the table in memory, run missing_countries.main() in the same process before.
+    """
+    # ddb.connect()
+    conn = conn or snoo.sn_connect()
 
-dose_light_geo = dose_light_geo.set_geometry("geometry")
-dose_light_geo["x"]=dose_light_geo.centr.x
-dose_light_geo["y"]=dose_light_geo.centr.y
+    boundaries = load_boundaries(conn)
+    print("Regions in the boundaries : ",boundaries.gid_1.nunique().execute())
 
+    # the partition of the year in the year partitioned output, typed parquet or the Arrow table of missing_countries.py in the same process
+    dose_light = dwi.read_dose_wdi(conn,f"{dose_wdi_path}{version}/dose_light_combined_{version}",years=[year])
+    dose_light = dose_light.rename("snake_case")
 
-# In[52]:
+    build_countries(conn)
+    dose_light_geo = attach_geometries(dose_light)
 
+    # contains some missing bits
+    print(unresolved_keys(conn,dose_light))
 
-# contains some missing bits. 
-dose_wdi_geo_filename = f"dose_wdi_geo_{version}"
-dose_wdi_geo_filepath = f"../datasets/local_data/dose-wdi/{version}/{dose_wdi_geo_filename}.parquet"
+    export(conn,dose_light_geo,version)
 
-if not os.path.exists(dose_wdi_geo_filepath):
-    dose_light_geo.to_parquet(dose_wdi_geo_filepath)
-else :
-    raise Warning(f"File already exists at '{dose_wdi_geo_filepath}'.")
+    return dose_light_geo
 
 
 # ## Plotting
@@ -361,8 +218,5 @@ else :
 # tf.shade(agg)
 
 
-# In[ ]:
-
-
-# 
-
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+# overrides.py
+"""Registry of the values patched into DOSE and WDI from other sources.
+
+Each row of the override table (data/overrides/overrides.csv) sets one value :
+    - dataset, variable : the table ('dose', 'wdi') and the column, e.g. 'pop' or a WDI indicator code
+    - gid_0, gid_1, region : the key, either the gid_1 of the region, the country and region name, or only the country
+    - year : the year of the value, empty for every year
+    - version : the version of the dose-wdi data set in which the override was added
+    - source : where the value comes from
+
+The overrides of a variable are applied with a single join on the keys, whatever their number, and for every year
+of the table at once. A key on gid_1 takes precedence over the region name, and a value of the year over an all years one.
+
+    dose, report = apply_overrides(dose, load_overrides("dose"), "pop")
+"""
+import pandas as pd
+
+overrides_file = "data/overrides/overrides.csv"
+
+override_columns = ["dataset", "variable", "gid_0", "gid_1", "region", "year", "value", "version", "source"]
+
+ireland_census_file = "../datasets/support_data/ireland/AllThemesTablesCTY.csv"
+
+# key types, from the most to the least specific
+key_priority = {"gid_1" : 0, "region" : 1, "country" : 2}
+
+
+def version_tuple(version: str) -> tuple:
+    return tuple(int(x) for x in str(version).split("_"))
+
+
+def load_overrides(dataset: str = None, version: str = None, path: str = overrides_file) -> pd.DataFrame:
+    """Override table, for a 'dataset' and the overrides added up to 'version', all by default."""
+    overrides = pd.read_csv(path, dtype={"gid_0" : str, "gid_1" : str, "region" : str, "version" : str, "source" : str})
+    overrides = overrides.astype({"year" : "Int64", "value" : float})
+
+    if dataset is not None:
+        overrides = overrides[overrides.dataset == dataset]
+    if version is not None:
+        overrides = overrides[overrides.version.map(version_tuple) <= version_tuple(version)]
+
+    return overrides.reset_index(drop=True)
+
+
+def ireland_census(path: str = ireland_census_file, version: str = "0_4") -> pd.DataFrame:
+    """Population of the Irish counties from the 2011 census as override rows, Ireland has no population in DOSE.
+    https://www.cso.ie/en/media/csoie/census/documents/saps2011files/AllThemesTablesCTY.csv
+    """
+    ireland = pd.read_csv(path, encoding="UTF-8")
+    ireland.columns = [x.lower() for x in ireland.columns]
+
+    ireland = ireland[["geogdesc", "t1_1agett"]].rename(columns={"geogdesc" : "region", "t1_1agett" : "value"})
+    # names as in DOSE
+    ireland["region"] = ireland["region"].replace({"Dublin City" : "Dublin", "Laois" : "Laoighis"})
+
+    # Tipperary is a single region in DOSE
+    tipperary = ireland.region.isin(["Tipperary North", "Tipperary South"])
+    ireland = pd.concat([ireland[~tipperary], pd.DataFrame([{"region" : "Tipperary", "value" : ireland.loc[tipperary, "value"].sum()}])])
+
+    return ireland.assign(dataset="dose", variable="pop", gid_0="IRL", gid_1=pd.NA, year=pd.NA,
+                          version=version, source="CSO census 2011, AllThemesTablesCTY")[override_columns]
+
+
+def override_keys(overrides: pd.DataFrame) -> pd.DataFrame:
+    """Join key and its type for each override."""
+    has_gid_1 = overrides.gid_1.notna()
+    has_region = overrides.region.notna()
+
+    key_type = pd.Series("country", index=overrides.index).mask(has_region, "region").mask(has_gid_1, "gid_1")
+    key = (overrides.gid_0.fillna("") + "|" + overrides.region.fillna("")).where(~has_gid_1, overrides.gid_1)
+
+    return overrides.assign(key=key, key_type=key_type)
+
+
+def apply_overrides(df: pd.DataFrame, overrides: pd.DataFrame, variable: str, only_missing: bool = True,
+                    gid_0: str = "gid_0", gid_1: str = "gid_1", region: str = "region", year: str = "year") -> tuple:
+    """Set the values of the overrides of 'variable' in 'df', only where the value is missing with 'only_missing'.
+    The columns of 'df' holding the keys are given by name, None when 'df' has no such column (e.g. region for WDI).
+    Returns the patched table and the applied overrides, with the row of 'df' ('row'), the key, year, value and source.
+    """
+    overrides = override_keys(overrides[overrides.variable == variable])
+    df = df.copy()
+
+    rows = pd.DataFrame({"row" : range(len(df)), "year" : df[year].to_numpy() if year is not None else pd.NA})
+    country = df[gid_0].fillna("").to_numpy() if gid_0 is not None else ""
+
+    # the candidate keys of each row, the rows are matched against the overrides in one join
+    candidates = [rows.assign(key=country + "|", key_type="country")]
+    if region is not None:
+        candidates.append(rows.assign(key=country + "|" + df[region].fillna("").to_numpy(), key_type="region"))
+    if gid_1 is not None:
+        candidates.append(rows.assign(key=df[gid_1].to_numpy(), key_type="gid_1"))
+
+    matched = pd.concat(candidates, ignore_index=True).merge(overrides, on=["key", "key_type"], suffixes=["", "_override"])
+    same_year = (matched.year_override == matched.year).astype("boolean").fillna(False)
+    matched = matched[matched.year_override.isna() | same_year]
+
+    # the most specific override of each row
+    matched = (matched
+               .assign(priority=matched.key_type.map(key_priority), all_years=matched.year_override.isna())
+               .sort_values(["row", "priority", "all_years"])
+               .drop_duplicates("row"))
+
+    if only_missing:
+        matched = matched[df[variable].isna().to_numpy()[matched.row.to_numpy()]]
+
+    df.iloc[matched.row.to_numpy(), df.columns.get_loc(variable)] = matched.value.to_numpy()
+
+    return df, matched[["row", "key_type", "key", "year", "value", "version", "source"]].reset_index(drop=True)
+
+
+def unused_overrides(overrides: pd.DataFrame, report: pd.DataFrame, variable: str) -> pd.DataFrame:
+    """Overrides of 'variable' that did not match any row, e.g. a misspelled region."""
+    overrides = override_keys(overrides[overrides.variable == variable])
+
+    return overrides[~overrides.key.isin(report.key)]
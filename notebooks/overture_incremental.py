@@ -0,0 +1,61 @@
+# overture_incremental.py
+"""Incremental update of the overture_pois table from a new Overture release.
+
+The new release is compared with the previous state of the table by feature `id` and a fingerprint of the location and category.
+Only the added or changed features go through the ISIC join and the H3 projection, removed and outdated features are deleted,
+and the duckdb table and the parquet output are both patched with the resulting delta.
+"""
+import ibis as ib
+
+import overture_layout as ovl
+
+# columns defining a version of a feature, any change in these triggers a reprojection.
+fingerprint_columns = ["x", "y", "sec_cat_id"]
+
+
+def with_fingerprint(table: ib.Table, columns: list = fingerprint_columns) -> ib.Table:
+    """Add a 'fp' column hashing the fingerprint columns of each feature."""
+    return table.alias("fp_src").sql(f"""SELECT *, hash({",".join(columns)}) as fp FROM fp_src;""")
+
+
+def diff_release(conn: ib.backends.duckdb.Backend, new: ib.Table, previous: ib.Table, columns: list = fingerprint_columns) -> tuple:
+    """Compare the features of the new release with the previous table.
+
+    Returns two tables of ids, materialised in the data base :
+        - overture_changed : features of the new release that are added or changed, to be joined and projected again.
+        - overture_stale : features of the previous table that are removed or changed, to be deleted.
+    """
+    new_fp = with_fingerprint(new.select("id", *columns), columns).select("id", "fp")
+    old_fp = with_fingerprint(previous.select("id", *columns), columns).select("id", "fp")
+
+    changed = conn.create_table("overture_changed", obj=new_fp.anti_join(old_fp, ["id", "fp"]).select("id"), overwrite=True)
+    stale = conn.create_table("overture_stale", obj=old_fp.anti_join(new_fp, ["id", "fp"]).select("id"), overwrite=True)
+
+    print(f"Release diff: {changed.count().execute()} added or changed, {stale.count().execute()} removed or outdated features.")
+
+    return changed, stale
+
+
+def apply_delta(conn: ib.backends.duckdb.Backend, delta: ib.Table, table_name: str = "overture_pois") -> ib.Table:
+    """Delete the stale features from 'table_name' and insert the reprojected delta.
+    The delta is materialised as 'overture_delta' so that the parquet output can be patched from it without recomputing it.
+    """
+    conn.create_table("overture_delta", obj=delta, overwrite=True)
+
+    conn.raw_sql(f"""
+    DELETE FROM {table_name} WHERE id IN (SELECT id FROM overture_stale);
+    INSERT INTO {table_name} BY NAME SELECT * FROM overture_delta;
+    """)
+
+    return conn.table(table_name)
+
+
+def patch_parquet(conn: ib.backends.duckdb.Backend, filename: str) -> str:
+    """Rewrite the parquet output without the stale features and with the delta appended, from the tables written by 'apply_delta'.
+    The file keeps its clustered layout and its row group index is rebuilt.
+    """
+    return ovl.write_clustered(conn, f"""(
+        SELECT * FROM read_parquet('{filename}') WHERE id NOT IN (SELECT id FROM overture_stale)
+        UNION ALL BY NAME
+        SELECT * FROM overture_delta
+    )""", filename)
@@ -0,0 +1,179 @@
+# overture_ingest.py
+"""Streaming ingest of the raw Overture places and land use releases.
+
+The bbox of interest is tested on the `bbox` struct columns of the release, which lets duckdb skip row groups from the parquet statistics
+instead of decoding every geometry. Only the projected columns are copied out to a hive partitioned parquet data set,
+no full copy of the release is built inside the data base.
+"""
+import os
+import glob
+import uuid
+import shutil
+
+import ibis as ib
+
+# raw releases, as downloaded in datasets/data_download.sh
+places_raw_path = "datasets/overture/raw/places/*"
+landuse_raw_path = "datasets/overture/raw/land_use/*"
+
+# streamed outputs
+ingest_path = "datasets/overture/processed/ingest"
+
+# size in degrees of the lon/lat tiles used as partitions of the streamed outputs
+partition_deg = 10
+
+# representative points of the land use polygons, cached per release and keyed by feature id
+landuse_points_path = "datasets/overture/processed/landuse_points"
+
+# strategies to reduce a land use polygon to a point, as SQL expressions of x and y
+point_strategies = {
+    # exact centroid, can fall outside of concave polygons
+    "centroid" : ("ST_X(ST_Centroid(geometry))", "ST_Y(ST_Centroid(geometry))"),
+    # midpoint of the bbox struct, no geometry decoding
+    "bbox" : ("(bbox.xmin+bbox.xmax)/2", "(bbox.ymin+bbox.ymax)/2"),
+    # point guaranteed to be inside the polygon
+    "surface" : ("ST_X(ST_PointOnSurface(geometry))", "ST_Y(ST_PointOnSurface(geometry))"),
+}
+
+# strategies decoding the geometry, the only ones worth caching
+cached_strategies = ["centroid", "surface"]
+
+
+def bbox_filter(bbox: list, point: bool = False) -> str:
+    """SQL predicate selecting the features of an Overture table inside 'bbox' ([xmin,ymin,xmax,ymax]) from the 'bbox' struct column only.
+    For points (places) the struct is degenerate and xmin/ymin are the coordinates, the bounds are half open so that adjacent bboxs
+    do not share points. For polygons any intersecting feature is kept.
+    """
+    if point:
+        return f"""bbox.xmin>={bbox[0]} and
+            bbox.xmin<{bbox[2]} and
+            bbox.ymin>={bbox[1]} and
+            bbox.ymin<{bbox[3]}"""
+
+    return f"""bbox.xmax>{bbox[0]} and
+            bbox.xmin<{bbox[2]} and
+            bbox.ymax>{bbox[1]} and
+            bbox.ymin<{bbox[3]}"""
+
+
+def tile_columns(x: str = "x", y: str = "y", deg: int = partition_deg) -> str:
+    """SQL expressions of the partition keys from the coordinates columns."""
+    return f"floor({x}/{deg})::INTEGER as tile_x, floor({y}/{deg})::INTEGER as tile_y"
+
+
+def copy_partitioned(conn: ib.backends.duckdb.Backend, query: str, out_path: str) -> str:
+    """Stream the result of 'query' into a parquet data set partitioned by tile_x/tile_y. Existing outputs at 'out_path' are replaced."""
+    if os.path.exists(out_path):
+        shutil.rmtree(out_path)
+    os.makedirs(os.path.dirname(out_path), exist_ok=True)
+
+    conn.raw_sql(f"""
+    COPY ({query}) TO '{out_path}' (FORMAT PARQUET, PARTITION_BY (tile_x, tile_y));
+    """)
+
+    # nothing in the bbox, e.g. an ocean tile : an empty part keeps the schema readable
+    if len(glob.glob(f"{out_path}/**/*.parquet", recursive=True)) == 0:
+        os.makedirs(out_path, exist_ok=True)
+        conn.raw_sql(f"""
+        COPY (SELECT * FROM ({query}) LIMIT 0) TO '{out_path}/empty.parquet' (FORMAT PARQUET);
+        """)
+
+    return out_path
+
+
+def stream_places(conn: ib.backends.duckdb.Backend, bbox: list, source: str = places_raw_path, out_path: str = f"{ingest_path}/places") -> str:
+    """Write the projected places (id, x, y, name, confidence, main, sec) inside 'bbox' to partitioned parquet."""
+    query = f"""
+    SELECT
+        id,
+        bbox.xmin as x,
+        bbox.ymin as y,
+        names.primary as name,
+        confidence,
+        categories.primary as main,
+        categories.alternate as sec,
+        {tile_columns("bbox.xmin","bbox.ymin")}
+    FROM read_parquet('{source}')
+    WHERE {bbox_filter(bbox, point=True)}
+    """
+    return copy_partitioned(conn, query, out_path)
+
+
+def points_cache_path(release: str, strategy: str) -> str:
+    """Folder holding the cached representative points of a release for a strategy."""
+    return f"{landuse_points_path}/{release}/{strategy}"
+
+
+def cache_landuse_points(conn: ib.backends.duckdb.Backend, bbox: list, release: str, strategy: str = "centroid", source: str = landuse_raw_path) -> str:
+    """Compute the representative points of the land use features intersecting 'bbox' that are not yet in the cache of the release,
+    and add them to it as a new part, if any. Points computed by previous runs, for any bbox, are reused.
+    """
+    if strategy not in point_strategies:
+        raise ValueError(f"Unknown point strategy '{strategy}', use one of {list(point_strategies.keys())}")
+
+    cache_path = points_cache_path(release, strategy)
+    os.makedirs(cache_path, exist_ok=True)
+
+    x, y = point_strategies[strategy]
+    not_cached = f"and id NOT IN (SELECT id FROM read_parquet('{cache_path}/*.parquet'))" if glob.glob(f"{cache_path}/*.parquet") else ""
+
+    conn.raw_sql(f"""
+    CREATE OR REPLACE TEMP TABLE landuse_points_new AS
+        SELECT id, {x} as x, {y} as y
+        FROM read_parquet('{source}')
+        WHERE {bbox_filter(bbox)} {not_cached};
+    """)
+
+    # a part is only added when there are new points, or to start the cache so that it can be read
+    if not_cached == "" or conn.table("landuse_points_new").count().execute() > 0:
+        # written under a temporary name, concurrent runs only ever read complete parts
+        part_filename = f"{cache_path}/part-{uuid.uuid4().hex}.parquet"
+        conn.raw_sql(f"""COPY landuse_points_new TO '{part_filename}.tmp' (FORMAT PARQUET);""")
+        os.replace(f"{part_filename}.tmp", part_filename)
+
+    conn.raw_sql("DROP TABLE landuse_points_new;")
+
+    return cache_path
+
+
+def cached_points(cache_path: str) -> str:
+    """SQL source of the (id, x, y) points of a cache folder, one row per id.
+    Workers on adjacent regions can both cache a feature crossing their edge before either part is written.
+    """
+    return f"(SELECT id, x, y FROM read_parquet('{cache_path}/*.parquet') QUALIFY row_number() OVER (PARTITION BY id) = 1)"
+
+
+def stream_landuse(conn: ib.backends.duckdb.Backend, bbox: list, release: str, strategy: str = "centroid", source: str = landuse_raw_path, out_path: str = f"{ingest_path}/land_use") -> str:
+    """Write the projected land use features (id, class, subtype, x, y) intersecting 'bbox' to partitioned parquet.
+    The representative point follows 'strategy' (see 'point_strategies'), geometry based points are read from the per release cache.
+    """
+    if strategy not in point_strategies:
+        raise ValueError(f"Unknown point strategy '{strategy}', use one of {list(point_strategies.keys())}")
+
+    if strategy in cached_strategies:
+        cache_path = cache_landuse_points(conn, bbox, release, strategy, source)
+        points = f"""
+        SELECT l.id, l.class, l.subtype, p.x, p.y
+        FROM read_parquet('{source}') l
+        JOIN {cached_points(cache_path)} p USING (id)
+        WHERE {bbox_filter(bbox)}
+        """
+    else:
+        x, y = point_strategies[strategy]
+        points = f"""
+        SELECT id, class, subtype, {x} as x, {y} as y
+        FROM read_parquet('{source}')
+        WHERE {bbox_filter(bbox)}
+        """
+
+    query = f"""
+    SELECT *, {tile_columns()} FROM ({points})
+    """
+    return copy_partitioned(conn, query, out_path)
+
+
+def read_ingested(conn: ib.backends.duckdb.Backend, path: str, table_name: str) -> ib.Table:
+    """Link a streamed data set as a view, the partition keys are dropped."""
+    return (conn
+            .read_parquet(f"{path}/**/*.parquet", table_name=table_name, hive_partitioning=True)
+            .drop("tile_x", "tile_y"))
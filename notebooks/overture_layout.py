@@ -0,0 +1,130 @@
+# overture_layout.py
+"""Spatially clustered layout of the processed Overture POIs parquet file.
+
+Rows are sorted by H3 cell before writing, so each capped row group covers a compact area. A small sidecar index
+records the bbox and the H3 range of each row group, the reader helpers use it to load only the row groups relevant to a bbox or a set of H3 cells.
+"""
+import os
+
+import pandas as pd
+import pyarrow.parquet as pq
+import ibis as ib
+
+# rows per row group of the clustered file
+row_group_size = 100_000
+
+
+def index_filename(filename: str) -> str:
+    """Sidecar index path of a clustered parquet file."""
+    return filename.replace(".parquet", "_index.parquet")
+
+
+def write_clustered(conn: ib.backends.duckdb.Backend, source: str, filename: str, sort_by: str = "h3_id", row_group_size: int = row_group_size) -> str:
+    """Write 'source' (a table name or a parenthesised query) sorted by 'sort_by' with capped row groups, along with its row group index.
+    The file is written next to 'filename' and swapped in once complete, so 'source' can read from 'filename' itself.
+    """
+    tmp_filename = f"{filename}.tmp"
+
+    conn.raw_sql(f"""
+    COPY (SELECT * FROM {source} ORDER BY {sort_by})
+        TO '{tmp_filename}' (FORMAT PARQUET, ROW_GROUP_SIZE {row_group_size});
+    """)
+    os.replace(tmp_filename, filename)
+
+    write_index(conn, filename, sort_by=sort_by)
+
+    return filename
+
+
+def write_index(conn: ib.backends.duckdb.Backend, filename: str, sort_by: str = "h3_id") -> pd.DataFrame:
+    """Build the row group index of 'filename' from the parquet statistics: bbox of the x/y columns and range of the 'sort_by' cells."""
+    index = conn.sql(f"""
+    SELECT
+        row_group_id as row_group,
+        any_value(row_group_num_rows) as num_rows,
+        min(CASE WHEN path_in_schema='x' THEN stats_min_value END)::DOUBLE as xmin,
+        max(CASE WHEN path_in_schema='x' THEN stats_max_value END)::DOUBLE as xmax,
+        min(CASE WHEN path_in_schema='y' THEN stats_min_value END)::DOUBLE as ymin,
+        max(CASE WHEN path_in_schema='y' THEN stats_max_value END)::DOUBLE as ymax,
+        min(CASE WHEN path_in_schema='{sort_by}' THEN stats_min_value::UBIGINT END) as h3_min,
+        max(CASE WHEN path_in_schema='{sort_by}' THEN stats_max_value::UBIGINT END) as h3_max
+    FROM parquet_metadata('{filename}')
+    GROUP BY row_group_id
+    ORDER BY row_group_id;
+    """).execute()
+
+    index.to_parquet(index_filename(filename), index=False)
+
+    return index
+
+
+def read_index(filename: str) -> pd.DataFrame:
+    """Load the sidecar index of a clustered parquet file."""
+    index_file = index_filename(filename)
+
+    if not os.path.exists(index_file):
+        raise IOError(f"No row group index for '{filename}', write it with 'write_clustered' or 'write_index'.")
+
+    return pd.read_parquet(index_file)
+
+
+def row_groups_bbox(filename: str, bbox: list) -> list:
+    """Row groups of 'filename' intersecting 'bbox' ([xmin,ymin,xmax,ymax])."""
+    index = read_index(filename)
+
+    selected = ((index.xmax >= bbox[0]) & (index.xmin <= bbox[2]) &
+                (index.ymax >= bbox[1]) & (index.ymin <= bbox[3]))
+
+    return index.loc[selected, "row_group"].tolist()
+
+
+def cell_list(cells: list) -> str:
+    """SQL literal of a list of cell ids."""
+    return f"[{','.join([str(int(x)) for x in cells])}]::UBIGINT[]"
+
+
+def row_groups_h3(conn: ib.backends.duckdb.Backend, filename: str, cells: list) -> list:
+    """Row groups of 'filename' containing children of any of the H3 'cells' (UBIGINT ids, all at the same resolution).
+    As the file is sorted by cell, the parents of the bounds of a row group at the query resolution bound the parents of all its rows.
+    """
+    index = conn.create_table("overture_layout_index", obj=read_index(filename), overwrite=True)
+
+    return (index
+            .alias("rg")
+            .sql(f"""
+            SELECT DISTINCT row_group FROM rg, (SELECT unnest({cell_list(cells)}) as cell) q
+            WHERE h3_cell_to_parent(rg.h3_min, h3_get_resolution(q.cell)) <= q.cell
+                AND h3_cell_to_parent(rg.h3_max, h3_get_resolution(q.cell)) >= q.cell
+            ORDER BY row_group;
+            """)
+            .execute()
+            .row_group
+            .tolist())
+
+
+def read_row_groups(conn: ib.backends.duckdb.Backend, filename: str, row_groups: list, table_name: str) -> ib.Table:
+    """Load only the listed row groups of 'filename' into a table."""
+    data = pq.ParquetFile(filename).read_row_groups(row_groups)
+
+    return conn.create_table(table_name, obj=data, overwrite=True)
+
+
+def read_bbox(conn: ib.backends.duckdb.Backend, filename: str, bbox: list, table_name: str = "pois_bbox") -> ib.Table:
+    """Read the rows of a clustered file inside 'bbox', touching only the intersecting row groups."""
+    table = read_row_groups(conn, filename, row_groups_bbox(filename, bbox), table_name)
+
+    return table.filter(table.x > bbox[0], table.x < bbox[2], table.y > bbox[1], table.y < bbox[3])
+
+
+def read_h3(conn: ib.backends.duckdb.Backend, filename: str, cells: list, table_name: str = "pois_h3") -> ib.Table:
+    """Read the rows of a clustered file falling in the H3 'cells', touching only the row groups covering them."""
+    if len(cells) == 0:
+        # empty table with the schema of the file
+        return read_row_groups(conn, filename, [], table_name)
+
+    table = read_row_groups(conn, filename, row_groups_h3(conn, filename, cells), table_name)
+
+    return table.alias("t").sql(f"""
+    SELECT * FROM t
+    WHERE h3_cell_to_parent(h3_id, h3_get_resolution({int(cells[0])}::UBIGINT)) IN (SELECT unnest({cell_list(cells)}));
+    """)
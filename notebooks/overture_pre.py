@@ -1,4 +1,3 @@
-
 # %%
 import os
 
@@ -15,12 +14,16 @@ ib.options.graphviz_repr = True
 
 ## Params
 from parameters import *
-from boundaries import bboxs,overture_db_filename
+import overture_ingest as ovi
+import overture_incremental as ovu
+import overture_layout as ovl
+import taxonomy as tx
+import h3_utils as h3u
 ## Guide on working with Overture
 
 ### https://docs.overturemaps.org/guides/
 
-### https://github.com/OvertureMaps/data?tab=readme-ov-file 
+### https://github.com/OvertureMaps/data?tab=readme-ov-file
 ## Analysis
 # the spatial extension
 # https://duckdb.org/docs/extensions/spatial/functions
@@ -28,147 +31,236 @@ from boundaries import bboxs,overture_db_filename
 # the h3 extension in duckdb
 # https://github.com/isaacbrodsky/h3-duckdb?tab=readme-ov-file
 
-conn = snoo.sn_connect(database=overture_db_filename,interactive=True, memory_limit="100GB",threads = 8)
-
-## Reading in the data
-## Selecting an area of interest
-bbox_name = 'global'
-bbox = bboxs[bbox_name]
-
-### Places
-conn.raw_sql(f"""
-CREATE or replace table places as (
-    select * from read_parquet('datasets/overture/raw/places/*')
-        where ST_X(geometry)>{bbox[0]} and
-             ST_X(geometry)<{bbox[2]} and
-             ST_Y(geometry)>{bbox[1]} and
-             ST_Y(geometry)<{bbox[3]}
-);
-""")
-
-places = conn.table(name="places")
-
-# places = snoo.sn_table(conn,"places",'datasets/overture/raw/places/*')
-
-### Reading landuse
-conn.raw_sql(f"""
-Create or replace table overture_landuse AS (
-    select * from read_parquet('datasets/overture/raw/land_use/*')
-         where bbox.xmax>{bbox[0]} and
-            bbox.xmin<{bbox[2]} and
-            bbox.ymax>{bbox[1]} and
-            bbox.ymin<{bbox[3]}                     
-);""")
-landuse = conn.table(name="overture_landuse")
-
-# landuse = snoo.sn_table(conn,"overture_landuse",'./datasets/overture/raw/land_use/*')
-
-## Places
-places = (
-    places
-    .mutate(x=_.bbox["xmin"],
-            y=_.bbox["ymin"],
-            name=_.names.primary,
-            main=_.categories["primary"],
-            sec = _.categories["alternate"],
-            )
-    .select("id","geometry","x","y","name","confidence","main","sec")
-    )
-
 # Selecting a starting resolution to project on H3.
 h3_res = 11
 
-### Working with places tags 
+overture_place_taxonomy_filename = "notebooks/data/overture_place_types.csv"
 
-### Aggregating categories
+places_exclude = ['structure_and_geography','religious_organization','health_and_medical','public_service_and_government',]
 
-overture_places_types = "https://raw.githubusercontent.com/OvertureMaps/schema/refs/heads/main/docs/schema/concepts/by-theme/places/overture_categories.csv"
+overture_remove = ["residential","farmyard","meadow","orchard","military","medical","cemetery","base",
+                   "trench","recreation_ground","clinic",'dog_park','animal_keeping','strict_nature_reserve',
+                   'pedestrian','national_park','training_area','state_park']
 
-places_types = pd.read_csv(overture_places_types,sep="; ",dtype={"Category code" : str, ' Overture Taxonomy' : list},engine='python')
 
-places_types.rename(columns={"Category code" : "category", 'Overture Taxonomy' : "taxonomy"},inplace=True)
+def connect(database: str = overture_db_filename, memory_limit: str = overture_memory_limit, threads: int = overture_threads) -> ib.backends.duckdb.Backend:
+    """Connection to the overture data base, with the spatial and h3 extensions."""
+    return snoo.sn_connect(database=database,interactive=True, memory_limit=memory_limit,threads = threads)
 
-places_types["taxonomy"] = places_types["taxonomy"].apply(lambda x : x.strip().replace("]","").replace("[","").split(","))
-places_types["main_cat"] = places_types["taxonomy"].apply(lambda x: x[0])
-places_types["sec_cat"] = places_types["taxonomy"].apply(lambda x: x[1] if len(x)>1  else x[0])
-places_types["raw_cat"] = places_types["taxonomy"].apply(lambda x: x[len(x)-1])
 
-overture_place_taxonomy_filename = "notebooks/data/overture_place_types.csv"
+def read_region(conn: ib.backends.duckdb.Backend, bbox: list, region: str = "global") -> tuple:
+    """Places and landuse tables of the raw release inside 'bbox', following 'overture_ingest_mode'.
+    The landuse table has its representative point in x/y.
+    """
+    if overture_ingest_mode == "stream":
+        ### Places and landuse streamed to partitioned parquet, filtered on the bbox struct
+        places_path = ovi.stream_places(conn, bbox, out_path=f"{ovi.ingest_path}/{region}/places")
+        landuse_path = ovi.stream_landuse(conn, bbox, release=overture_release, strategy=landuse_point_strategy, out_path=f"{ovi.ingest_path}/{region}/land_use")
 
-if not os.path.exists(overture_place_taxonomy_filename):
-    places_types[["main_cat","sec_cat","raw_cat"]].to_csv(overture_place_taxonomy_filename,index=False)
-else : 
-    print("File exists")
+        places = ovi.read_ingested(conn, places_path, "places")
+        landuse = ovi.read_ingested(conn, landuse_path, "overture_landuse")
 
-conn.create_table(obj=places_types[["raw_cat","main_cat","sec_cat"]],
-                           name="places_types",
-                           overwrite=True,
-                           schema={
-                               "raw_cat" : ib.dtype("string"),
-                               "main_cat" : ib.dtype("string"),
-                               "sec_cat" : ib.dtype("string"),
-})
+        return places, landuse
 
-places_types = conn.table("places_types")
+    ### Places
+    conn.raw_sql(f"""
+    CREATE or replace table places as (
+        select * from read_parquet('{ovi.places_raw_path}')
+            where ST_X(geometry)>{bbox[0]} and
+                 ST_X(geometry)<{bbox[2]} and
+                 ST_Y(geometry)>{bbox[1]} and
+                 ST_Y(geometry)<{bbox[3]}
+    );
+    """)
 
-#%%
+    places = conn.table(name="places")
 
-places = places.join(right=places_types,predicates=places.main==places_types.raw_cat,how="left")
-places_exclude = ['structure_and_geography','religious_organization','health_and_medical','public_service_and_government',]
-places_poi = places[~places["main_cat"].isin(places_exclude)]
+    # places = snoo.sn_table(conn,"places",'datasets/overture/raw/places/*')
+
+    ### Reading landuse
+    conn.raw_sql(f"""
+    Create or replace table overture_landuse AS (
+        select * from read_parquet('{ovi.landuse_raw_path}')
+             where {ovi.bbox_filter(bbox)}
+    );""")
+    landuse = conn.table(name="overture_landuse")
+
+    # landuse = snoo.sn_table(conn,"overture_landuse",'./datasets/overture/raw/land_use/*')
+
+    ## Places
+    places = (
+        places
+        .mutate(x=_.bbox["xmin"],
+                y=_.bbox["ymin"],
+                name=_.names.primary,
+                main=_.categories["primary"],
+                sec = _.categories["alternate"],
+                )
+        .select("id","geometry","x","y","name","confidence","main","sec")
+        )
+
+    ## Landuse representative points, from the same per release cache as the streamed ingest
+    if landuse_point_strategy == "bbox":
+        landuse = landuse.mutate(x=(_.bbox["xmin"]+_.bbox["xmax"])/2,y=(_.bbox["ymin"]+_.bbox["ymax"])/2)
+    else:
+        cache_path = ovi.cache_landuse_points(conn, bbox, release=overture_release, strategy=landuse_point_strategy)
+        points = conn.sql(f"SELECT id, x, y FROM {ovi.cached_points(cache_path)}")
+        landuse = landuse.join(points, "id")
 
-## Landuse
-landuse = landuse.mutate(centroid = _.geometry.centroid())
+    return places, landuse
 
-landuse_class = landuse.select("class").distinct().execute().get("class").tolist()
-landuse_subtype = landuse.select("subtype").distinct().execute().get("subtype").tolist()
 
-landuse_class_type = landuse.select("class","subtype").distinct().execute().apply(lambda x: " ".join(x),axis=1)
+### Working with places tags
 
-landuse = (
-    landuse
-    .mutate(x=_.centroid.x(),y=_.centroid.y())
-    .select("id","class","subtype","x","y")
+### Aggregating categories
+
+def load_places_types(conn: ib.backends.duckdb.Backend) -> ib.Table:
+    """Overture places taxonomy as a (raw_cat, main_cat_id, sec_cat_id) table."""
+    # parsed once from the local taxonomy store, no download
+    places_types = tx.load_source("overture_categories")
+
+    if not os.path.exists(overture_place_taxonomy_filename):
+        places_types[["main_cat","sec_cat","raw_cat"]].to_csv(overture_place_taxonomy_filename,index=False)
+    else :
+        print("File exists")
+
+    # the raw category is only kept for the join with the places, the rest is carried as codes
+    places_types = tx.encode_df(places_types[["raw_cat","main_cat","sec_cat"]], "main_cat", "category")
+    places_types = tx.encode_df(places_types, "sec_cat", "category")
+
+    conn.create_table(obj=places_types[["raw_cat","main_cat_id","sec_cat_id"]],
+                               name="places_types",
+                               overwrite=True,
+                               schema={
+                                   "raw_cat" : ib.dtype("string"),
+                                   "main_cat_id" : ib.dtype("int16"),
+                                   "sec_cat_id" : ib.dtype("int16"),
+    })
+
+    return conn.table("places_types")
+
+
+def load_poi_to_isic(conn: ib.backends.duckdb.Backend) -> ib.Table:
+    """Category to ISIC table with the category, ISIC section and DOSE sector as codes.
+    The descriptions of the ISIC divisions (isic_embed) are kept apart in the isic_divisions table.
+    """
+    ## POI to ISIC
+    poi_to_isic = pd.read_csv("notebooks/" + place_types_filename)
+    # poi_to_isic = poi_to_isic[poi_to_isic.match_score > 0.4]
+
+    conn.create_table(obj=poi_to_isic[["isic_embed","isic_descr"]].drop_duplicates(),name="isic_divisions",overwrite=True)
+
+    poi_to_isic = tx.encode_df(poi_to_isic, "sec_cat", "category")
+    poi_to_isic = tx.encode_df(poi_to_isic, "section", "section")
+    poi_to_isic = tx.encode_df(poi_to_isic, "dose", "dose")
+
+    return conn.create_table(obj=poi_to_isic[["sec_cat_id","section_id","isic_embed","dose_id","match_score"]],
+                             name="poi_to_isic",
+                             overwrite=True)
+
+
+def update_lookups(conn: ib.backends.duckdb.Backend):
+    """Register every category of the taxonomy, the ISIC table and the raw landuse release in the lookups.
+    Run before processing regions in parallel, so that the workers only read the lookups.
+    """
+    load_places_types(conn)
+    load_poi_to_isic(conn)
+    tx.update_codes("category", conn.sql(f"SELECT DISTINCT class FROM read_parquet('{ovi.landuse_raw_path}');").execute()["class"])
+
+    return tx.create_lookups(conn)
+
+
+def combine_pois(conn: ib.backends.duckdb.Backend, places: ib.Table, landuse: ib.Table) -> ib.Table:
+    """Union of the categorised places and the landuse points as (id, sec_cat_id, x, y), without the excluded categories."""
+    places_types = load_places_types(conn)
+
+    places = places.join(right=places_types,predicates=places.main==places_types.raw_cat,how="left")
+    places_poi = places[~places["main_cat_id"].isin(tx.to_codes("category", places_exclude))]
+
+    landuse = tx.encode(conn, landuse, "class", "category", new_column="sec_cat_id")
+
+    ## Combining landuse and places
+
+    # the ibis way
+    overture_data_ = ib.union(
+        (landuse
+         .select("id", "sec_cat_id","x","y")
+         .cast({"x" : "float32",
+                "y" : "float32",})
+                ),
+        (places_poi
+         .select("id","sec_cat_id","x","y")
+         .cast({"x" : "float32",
+                "y" : "float32",})
+                ),
     )
 
-landuse_class_type.to_csv("notebooks/data/overture_landuse_type.csv",index=False)
-
-## POI to ISIC
-poi_to_isic = conn.read_csv("notebooks/" + place_types_filename)
-# poi_to_isic = poi_to_isic.filter(_.match_score > 0.4)
-
-## Combining landuse and places 
-
-# the ibis way
-overture_data_ = ib.union(
-    (landuse
-     .select("id", "class","x","y")
-     .rename({"sec_cat" : "class"})
-     .cast({"x" : "float32",
-            "y" : "float32",})
-            ),
-    (places_poi
-     .select("id","sec_cat","x","y")
-     .cast({"x" : "float32",
-            "y" : "float32",})
-            ),
-)
+    return overture_data_.filter(~_.sec_cat_id.isin(tx.to_codes("category", overture_remove)))
 
-overture_remove = ["residential","farmyard","meadow","orchard","military","medical","cemetery","base",
-                   "trench","recreation_ground","clinic",'dog_park','animal_keeping','strict_nature_reserve',
-                   'pedestrian','national_park','training_area','state_park']
 
-overture_data = overture_data_.filter(~_.sec_cat.isin(overture_remove))
+def project_pois(conn: ib.backends.duckdb.Backend, overture_data: ib.Table) -> ib.Table:
+    """Join the ISIC categories on the category codes and project on H3 at 'h3_res', with the parent cells of 'h3_pyramid_res'."""
+    poi_to_isic = load_poi_to_isic(conn)
+
+    overture_data = overture_data.join(poi_to_isic,predicates="sec_cat_id",how="left")
+
+    # UBIGINT cell ids, see h3_utils.py
+    overture_data = h3u.project(overture_data,res=h3_res)
+
+    return h3u.add_pyramid(overture_data, h3_pyramid_res, fine_res=h3_res)
+
+
+def in_bbox(table: ib.Table, bbox: list) -> ib.Table:
+    """Features of 'table' whose point is inside 'bbox', with half open bounds."""
+    return table.filter(table.x >= bbox[0], table.x < bbox[2], table.y >= bbox[1], table.y < bbox[3])
+
+
+def main(bbox_name: str = "global"):
+    from boundaries import bboxs
+
+    conn = connect()
+
+    ## Reading in the data
+    ## Selecting an area of interest
+    bbox = bboxs[bbox_name]
+
+    places, landuse = read_region(conn, bbox, region=bbox_name)
+
+    ## Landuse
+    landuse_class_type = landuse.select("class","subtype").distinct().execute().apply(lambda x: " ".join(x),axis=1)
+    landuse_class_type.to_csv("notebooks/data/overture_landuse_type.csv",index=False)
+
+    overture_data = combine_pois(conn, places, landuse)
+
+    # only the features added or changed since the previous release go through the joins and projection
+    incremental = overture_update_mode == "incremental" and "overture_pois" in conn.list_tables()
+
+    if incremental:
+        # a regional release is compared with the same region of the table, half open bounds as in overture_scheduler.py,
+        # the features of the table outside the bbox are neither stale nor duplicated
+        overture_data = in_bbox(overture_data, bbox)
+        overture_changed, overture_stale = ovu.diff_release(conn, overture_data, in_bbox(conn.table("overture_pois"), bbox))
+        overture_data = overture_data.semi_join(overture_changed, "id")
+
+    overture_data = project_pois(conn, overture_data)
+
+    tx.create_lookups(conn)
+
+    if incremental:
+        ## patching the table and the saved file with the delta
+        ovu.apply_delta(conn, overture_data, table_name="overture_pois")
+        ovu.patch_parquet(conn, overture_places_landuses_filename)
 
-overture_data = overture_data.join(poi_to_isic[["sec_cat","section","isic_embed","isic_descr","dose","match_score"]],predicates="sec_cat",how="left")
+    else:
+        conn.create_table(obj=overture_data,name="overture_pois",overwrite=True)
 
-overture_data = snoo.sn_project(overture_data,res=h3_res)
+        ## saving full file, clustered by h3 cell with a row group index for the readers in overture_layout.py
 
-conn.create_table(obj=overture_data,name="overture_pois")
+        # if not os.path.exists(overture_places_landuses_filename):
+        ovl.write_clustered(conn, "overture_pois", overture_places_landuses_filename)
+        # else :
+        #     print("File exists")
 
-## saving full file
 
-# if not os.path.exists(overture_places_landuses_filename):
-overture_data.to_parquet(overture_places_landuses_filename,overwrite=True)
-# else :
-#     print("File exists")
\ No newline at end of file
+if __name__ == "__main__":
+    main()
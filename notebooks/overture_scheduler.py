@@ -0,0 +1,121 @@
+# overture_scheduler.py
+"""Parallel processing of the Overture preprocessing over several regions.
+
+Each region (a continent from bboxs.json or a tile of a bbox) is processed by overture_pre in its own process with an in memory
+data base. The memory and thread budget of each worker is derived from the machine size so that all workers together stay below it.
+The per region outputs are written to parquet and merged into the overture_pois table and the clustered places_landuses.parquet file.
+
+    python overture_scheduler.py  # global bbox in tiles of 'tile_deg' degrees
+"""
+import os
+import glob
+import shutil
+import itertools as iter
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import overture_pre as ovp
+import overture_layout as ovl
+from parameters import overture_places_landuses_filename
+
+# per region outputs
+regions_path = "datasets/overture/processed/regions"
+
+# default tiling of the global bbox, in degrees
+tile_deg = 30
+
+# fraction of the physical memory shared between the workers
+memory_frac = 0.8
+
+
+def tile_regions(bbox: list, deg: float = tile_deg, name: str = "tile") -> dict:
+    """Split 'bbox' in a grid of non overlapping tiles of 'deg' degrees, as {name : bbox}."""
+    xs = [bbox[0] + i*deg for i in range(int((bbox[2]-bbox[0])//deg) + 1)] + [bbox[2]]
+    ys = [bbox[1] + i*deg for i in range(int((bbox[3]-bbox[1])//deg) + 1)] + [bbox[3]]
+
+    return {f"{name}_{i}_{j}" : [xs[i], ys[j], xs[i+1], ys[j+1]]
+            for i, j in iter.product(range(len(xs)-1), range(len(ys)-1))
+            if xs[i] < xs[i+1] and ys[j] < ys[j+1]}
+
+
+def check_overlaps(regions: dict):
+    """Regions are merged without deduplication, so they must not overlap."""
+    for (name_a, a), (name_b, b) in iter.combinations(regions.items(), 2):
+        if a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]:
+            raise ValueError(f"Regions '{name_a}' and '{name_b}' overlap, features would be duplicated in the merged output.")
+
+
+def worker_budget(n_workers: int) -> dict:
+    """Threads and memory limit of each worker, splitting the cores and a fraction of the physical memory of the machine."""
+    cores = os.cpu_count()
+    memory_gb = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") / 1024**3
+
+    return {
+        "threads" : max(1, cores // n_workers),
+        "memory_limit" : f"{max(1, int(memory_frac * memory_gb / n_workers))}GB",
+    }
+
+
+def run_region(region: str, bbox: list, threads: int, memory_limit: str) -> str:
+    """Process a single region in an in memory data base and write its POIs to parquet. Runs in a worker process."""
+    conn = ovp.connect(database=":memory:", memory_limit=memory_limit, threads=threads)
+
+    places, landuse = ovp.read_region(conn, bbox, region=region)
+    overture_data = ovp.combine_pois(conn, places, landuse)
+
+    # half open bounds, a point on the edge between two regions belongs to one only
+    overture_data = overture_data.filter(overture_data.x >= bbox[0], overture_data.x < bbox[2],
+                                         overture_data.y >= bbox[1], overture_data.y < bbox[3])
+
+    out_file = f"{regions_path}/{region}.parquet"
+    ovp.project_pois(conn, overture_data).to_parquet(out_file)
+
+    return out_file
+
+
+def merge_regions(database: str = ovp.overture_db_filename, filename: str = overture_places_landuses_filename):
+    """Merge the per region outputs into the overture_pois table and the clustered parquet file."""
+    conn = ovp.connect(database=database)
+
+    conn.raw_sql(f"""
+    CREATE OR REPLACE TABLE overture_pois AS SELECT * FROM read_parquet('{regions_path}/*.parquet');
+    """)
+    ovl.write_clustered(conn, "overture_pois", filename)
+    ovp.tx.create_lookups(conn)
+
+    return conn.table("overture_pois")
+
+
+def run(regions: dict, n_workers: int = None, merge: bool = True):
+    """Process 'regions' ({name : bbox}) in a process pool and merge the outputs.
+    By default one worker per 8 cores, the largest regions are submitted first.
+    """
+    check_overlaps(regions)
+
+    n_workers = n_workers or max(1, os.cpu_count() // 8)
+    budget = worker_budget(n_workers)
+    print(f"Running {len(regions)} regions on {n_workers} workers with {budget['threads']} threads and {budget['memory_limit']} each.")
+
+    if os.path.exists(regions_path):
+        shutil.rmtree(regions_path)
+    os.makedirs(regions_path)
+
+    # all the category codes are assigned here, the workers only read the lookups
+    ovp.update_lookups(ovp.connect(database=":memory:"))
+
+    by_area = sorted(regions.items(), key=lambda x: (x[1][2]-x[1][0])*(x[1][3]-x[1][1]), reverse=True)
+
+    with ProcessPoolExecutor(max_workers=n_workers) as pool:
+        futures = {pool.submit(run_region, region, bbox, **budget) : region for region, bbox in by_area}
+        for future in as_completed(futures):
+            print(f"Region '{futures[future]}' written to '{future.result()}'.")
+
+    if merge:
+        return merge_regions()
+
+    return glob.glob(f"{regions_path}/*.parquet")
+
+
+if __name__ == "__main__":
+    from boundaries import bboxs
+
+    run(tile_regions(bboxs["global"], name="global"))
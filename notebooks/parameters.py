@@ -8,6 +8,14 @@ from numpy import mean
 # DOSE WDI PROCESSING
 # this is the year for which to generate the dose-wdi data set, easier to set from here than looking for it across the notebook.
 year = 2015
+# years filled in one run by missing_countries.py, a list or None for all the DOSE years. The output is partitioned by year.
+years = [year]
+# version of the dose-wdi data set written by missing_countries.py and read by missing_countries_geo.py
+version = "0_4"
+dose_wdi_path = "../datasets/local_data/dose-wdi/"
+# weights of the missing regions in the allocation of the national residual (gap_filling.py) :
+# "uniform", "area" (of the boundaries) or the path of a csv with gid_1, weight and optionally year columns, e.g. populations
+allocation_weights = "uniform"
 
 # print(Path.cwd())
 # https://www.btelligent.com/en/blog/best-practice-working-with-paths-in-python-part-1-2
@@ -58,6 +66,9 @@ map_limits = [-168.8, -56.9, 189.8, 77.7]
 ####
 agg_res = 4
 
+# parent resolutions stored with the projected POIs (h3_utils.py), any aggregation in this range is a groupby
+h3_pyramid_res = range(3, 11)
+
 ##
 # LLM for classification
 # Load the Sentence-BERT model
@@ -76,6 +87,23 @@ place_types_filename = f"/data/place_types_isic_{selected_model}.csv"
 
 overture_db_filename = "datasets/overture/overture_db.duckdb"
 
+# "stream" : bbox filtering on the struct columns and projected columns written to partitioned parquet (overture_ingest.py)
+# "table" : full copy of the bbox into the duckdb file
+overture_ingest_mode = "stream"
+
+# release of the raw Overture data, used to key the cached land use points
+overture_release = "2024-10-23.0"
+
+# representative point of the land use polygons : "centroid", "bbox" (no geometry decoding) or "surface" (point on surface)
+landuse_point_strategy = "centroid"
+
+# "full" : rebuild overture_pois from the whole release
+# "incremental" : only reproject the features added or changed since the previous release (overture_incremental.py)
+overture_update_mode = "full"
+
+overture_memory_limit = "100GB"
+overture_threads = 8
+
 ## paths
 
 # project_repo = lib
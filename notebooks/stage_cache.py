@@ -0,0 +1,122 @@
+# stage_cache.py
+"""Memoisation of the stages of the dose-wdi pipeline (missing_countries.py) to parquet.
+
+A stage is a function returning a data frame. Its result is stored under a key hashed from :
+    - the content of its input files
+    - its parameters (years, thresholds, indicators, ...)
+    - its code : the source of the stage function and of the helper modules it uses
+    - the keys of the upstream stages
+A rerun with the same key reads the parquet instead of computing the stage, any change to the data, parameters or code
+recomputes it and the stages after it.
+
+    dose_year, dose_year_key = stage("dose_year", dose_year_stage, inputs=[ecd.dose_file], params={"years" : run_years})
+"""
+import os
+import json
+import hashlib
+import inspect
+import marshal
+
+import pandas as pd
+
+stage_cache_path = "../datasets/local_data/dose-wdi/stages"
+
+# file hashes are kept with the size and modification time of the file, the large csvs are only hashed when they change
+fingerprints_filename = "fingerprints.json"
+
+
+def file_hash(path: str, chunk_size: int = 2**20) -> str:
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha.update(chunk)
+
+    return sha.hexdigest()
+
+
+def fingerprint(path: str, cache_dir: str = stage_cache_path) -> str:
+    """Content hash of a file, or of all the files of a directory."""
+    if os.path.isdir(path):
+        files = sorted([os.path.join(root, x) for root, _, names in os.walk(path) for x in names])
+        return hashlib.sha256("".join([fingerprint(x, cache_dir) for x in files]).encode()).hexdigest()
+
+    fingerprints_file = os.path.join(cache_dir, fingerprints_filename)
+    fingerprints = {}
+    if os.path.exists(fingerprints_file):
+        with open(fingerprints_file) as f:
+            fingerprints = json.load(f)
+
+    stat = os.stat(path)
+    entry = fingerprints.get(os.path.abspath(path))
+    if entry is not None and entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime_ns:
+        return entry["hash"]
+
+    digest = file_hash(path)
+    fingerprints[os.path.abspath(path)] = {"size" : stat.st_size, "mtime" : stat.st_mtime_ns, "hash" : digest}
+
+    os.makedirs(cache_dir, exist_ok=True)
+    with open(fingerprints_file, "w") as f:
+        json.dump(fingerprints, f, indent=1)
+
+    return digest
+
+
+def source(code) -> bytes:
+    """Source of a function, module or file. The byte code of a function without source, e.g. defined in a console."""
+    if isinstance(code, str):
+        with open(code, "rb") as f:
+            return f.read()
+    try:
+        return inspect.getsource(code).encode()
+    except OSError:
+        return marshal.dumps(code.__code__)
+
+
+def code_hash(code) -> str:
+    """Hash of the source of functions, modules or files."""
+    return hashlib.sha256(b"".join([source(x) for x in code])).hexdigest()
+
+
+def stage_key(name: str, inputs: list = (), params: dict = None, code: list = (), upstream: list = (), cache_dir: str = stage_cache_path) -> str:
+    """Key of a stage from its input files, parameters, code and upstream stage keys."""
+    content = {
+        "name" : name,
+        "inputs" : {x : fingerprint(x, cache_dir) for x in inputs},
+        "params" : params or {},
+        "code" : code_hash(code),
+        "upstream" : list(upstream),
+    }
+    # default=str for the numpy and pandas values of the parameters
+    return hashlib.sha256(json.dumps(content, sort_keys=True, default=str).encode()).hexdigest()[:16]
+
+
+def stage_filename(name: str, key: str, cache_dir: str = stage_cache_path) -> str:
+    return os.path.join(cache_dir, name, f"{key}.parquet")
+
+
+def stage(name: str, compute, inputs: list = (), params: dict = None, code: list = (), upstream: list = (),
+          kwargs: dict = None, refresh: bool = False, cache_dir: str = stage_cache_path) -> tuple:
+    """Result of 'compute(**kwargs)' for the stage 'name', read from the cache when the key is unchanged.
+    The source of 'compute' is always part of the code of the stage, the 'kwargs' are not part of the key : tables
+    passed to the stage enter the key through 'params', 'inputs' or 'upstream'.
+    Returns the data frame and the key of the stage.
+    """
+    key = stage_key(name, inputs, params, [compute, *code], upstream, cache_dir)
+    filename = stage_filename(name, key, cache_dir)
+
+    if not refresh and os.path.exists(filename):
+        print(f"Stage '{name}' read from '{filename}'.")
+        return pd.read_parquet(filename), key
+
+    df = compute(**(kwargs or {}))
+
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    df.to_parquet(filename, index=False)
+    print(f"Stage '{name}' written to '{filename}'.")
+
+    return df, key
+
+
+def frame_hash(df: pd.DataFrame) -> str:
+    """Hash of the content of a data frame, to use an intermediate table computed outside the stages as a parameter."""
+    return hashlib.sha256(pd.util.hash_pandas_object(df, index=False).to_numpy().tobytes()).hexdigest()[:16]
@@ -0,0 +1,208 @@
+# taxonomy.py
+"""Taxonomies used to categorise the POIs, and compact integer encoding of the categorical columns of the POI pipeline.
+
+The Overture categories and the ISIC Rev 4 structure are downloaded once into a local store, checksummed and parsed into typed parquet.
+They are then loaded from disk, the pipeline runs without network access and the store is only refreshed on request:
+
+    python taxonomy.py --refresh
+
+Overture categories (places taxonomy and land use classes), ISIC sections and DOSE sectors are carried as small integers
+through the joins and in the outputs. The lookup tables to decode them are stored in data/codes/ and only ever appended to,
+so that a code keeps its meaning across releases and incremental updates.
+"""
+import os
+import io
+import sys
+import json
+import hashlib
+import datetime
+import urllib.request
+
+import pandas as pd
+import ibis as ib
+
+codes_path = os.path.join(os.path.dirname(__file__), "data", "codes")
+
+store_path = os.path.join(os.path.dirname(__file__), "data", "taxonomy_store")
+manifest_filename = os.path.join(store_path, "manifest.json")
+
+
+def parse_overture_categories(raw: bytes) -> pd.DataFrame:
+    """Overture places categories ('code; [taxonomy,...]' lines) with the main, secondary and raw category of each."""
+    lines = raw.decode("utf-8").strip().splitlines()[1:]
+    places_types = pd.DataFrame([line.split("; ", 1) for line in lines], columns=["category","taxonomy"])
+
+    taxonomy = places_types["taxonomy"].str.strip().str.strip("[]").str.split(",")
+    places_types["taxonomy"] = taxonomy
+    places_types["main_cat"] = taxonomy.str[0]
+    places_types["sec_cat"] = taxonomy.str[1].fillna(taxonomy.str[0])
+    places_types["raw_cat"] = taxonomy.str[-1]
+
+    return places_types
+
+
+def parse_isic(raw: bytes) -> pd.DataFrame:
+    """ISIC Rev 4 structure, codes are kept as strings to preserve the leading zeros."""
+    return pd.read_csv(io.BytesIO(raw), dtype=str)
+
+
+sources = {
+    "overture_categories" : {
+        "url" : "https://raw.githubusercontent.com/OvertureMaps/schema/refs/heads/main/docs/schema/concepts/by-theme/places/overture_categories.csv",
+        "parse" : parse_overture_categories,
+    },
+    "isic_rev4" : {
+        "url" : "https://unstats.un.org/unsd/classifications/Econ/Download/In%20Text/ISIC_Rev_4_english_structure.Txt",
+        "parse" : parse_isic,
+    },
+}
+
+
+def sha256(path: str) -> str:
+    with open(path, "rb") as fh:
+        return hashlib.sha256(fh.read()).hexdigest()
+
+
+def load_manifest() -> dict:
+    if not os.path.exists(manifest_filename):
+        return {}
+    with open(manifest_filename, "r") as fh:
+        return json.load(fh)
+
+
+def fetch_source(name: str) -> dict:
+    """Download a source into the store, parse it to parquet and record the checksums of both files in the manifest."""
+    source = sources[name]
+    os.makedirs(store_path, exist_ok=True)
+
+    with urllib.request.urlopen(source["url"]) as response:
+        raw = response.read()
+
+    raw_filename = os.path.join(store_path, f"{name}.raw")
+    with open(raw_filename, "wb") as fh:
+        fh.write(raw)
+
+    parquet_filename = os.path.join(store_path, f"{name}.parquet")
+    source["parse"](raw).to_parquet(parquet_filename, index=False)
+
+    manifest = load_manifest()
+    manifest[name] = {
+        "url" : source["url"],
+        "fetched" : datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "raw_sha256" : sha256(raw_filename),
+        "parquet_sha256" : sha256(parquet_filename),
+    }
+    with open(manifest_filename, "w") as fh:
+        json.dump(manifest, fh, indent=2)
+
+    return manifest[name]
+
+
+def load_source(name: str, refresh: bool = False) -> pd.DataFrame:
+    """Parsed source from the local store. It is only downloaded when missing from the store or when 'refresh' is set."""
+    parquet_filename = os.path.join(store_path, f"{name}.parquet")
+
+    if refresh or name not in load_manifest() or not os.path.exists(parquet_filename):
+        print(f"Fetching '{name}' into the taxonomy store.")
+        fetch_source(name)
+
+    if sha256(parquet_filename) != load_manifest()[name]["parquet_sha256"]:
+        raise IOError(f"Checksum mismatch for '{parquet_filename}', refresh the store with 'python taxonomy.py --refresh'.")
+
+    return pd.read_parquet(parquet_filename)
+
+# name of each lookup : (code column, value column, integer type)
+lookups = {
+    "category" : ("cat_id", "cat", "int16"),
+    "section" : ("section_id", "section", "int8"),
+    "dose" : ("dose_id", "dose", "int8"),
+}
+
+
+def lookup_filename(name: str) -> str:
+    return os.path.join(codes_path, f"{name}_codes.csv")
+
+
+def load_codes(name: str) -> pd.DataFrame:
+    """Lookup table of 'name', empty if it was never written."""
+    code, value, dtype = lookups[name]
+
+    if not os.path.exists(lookup_filename(name)):
+        return pd.DataFrame({code : pd.Series(dtype=dtype), value : pd.Series(dtype=str)})
+
+    return pd.read_csv(lookup_filename(name), dtype={code : dtype, value : str})
+
+
+def update_codes(name: str, values) -> pd.DataFrame:
+    """Add the unseen 'values' to the lookup table of 'name' with new codes, existing codes are never changed."""
+    code, value, dtype = lookups[name]
+    codes = load_codes(name)
+
+    new_values = sorted(set(pd.Series(values).dropna()) - set(codes[value]))
+
+    if len(new_values) > 0:
+        start = codes[code].max() + 1 if len(codes) > 0 else 1
+        new_codes = pd.DataFrame({code : range(start, start + len(new_values)), value : new_values})
+        codes = pd.concat([codes, new_codes], ignore_index=True).astype({code : dtype})
+
+        os.makedirs(codes_path, exist_ok=True)
+        codes.to_csv(lookup_filename(name), index=False)
+
+    return codes
+
+
+def to_codes(name: str, values: list) -> list:
+    """Codes of a list of values, for filters on the encoded columns."""
+    code, value, _ = lookups[name]
+    codes = load_codes(name)
+
+    return codes.loc[codes[value].isin(values), code].tolist()
+
+
+def encode_df(df: pd.DataFrame, column: str, name: str, drop: bool = True) -> pd.DataFrame:
+    """Add the '{column}_id' code column to a small pandas table, the lookup is updated with any new value."""
+    code, value, dtype = lookups[name]
+    mapping = update_codes(name, df[column]).set_index(value)[code]
+
+    # nullable integers, values without category stay missing
+    df = df.assign(**{f"{column}_id" : df[column].map(mapping).astype(dtype.capitalize())})
+
+    return df.drop(columns=column) if drop else df
+
+
+def create_lookups(conn: ib.backends.duckdb.Backend) -> dict:
+    """Write the lookup tables in the data base as '{name}_codes' to decode the outputs."""
+    return {name : conn.create_table(f"{name}_codes", obj=load_codes(name), overwrite=True) for name in lookups.keys()}
+
+
+def encode(conn: ib.backends.duckdb.Backend, table: ib.Table, column: str, name: str, new_column: str = None) -> ib.Table:
+    """Replace the string 'column' of a table by its code in the lookup of 'name', as 'new_column' ('{column}_id' by default).
+    The distinct values of the column are registered in the lookup first, this join on strings is only done once at the ingest.
+    """
+    code, value, _ = lookups[name]
+    new_column = new_column or f"{column}_id"
+
+    update_codes(name, table.select(column).distinct().execute()[column])
+    lookup = (conn
+              .create_table(f"{name}_codes", obj=load_codes(name), overwrite=True)
+              .rename({new_column : code, f"{column}_lookup" : value}))
+
+    return table.left_join(lookup, table[column] == lookup[f"{column}_lookup"]).drop(column, f"{column}_lookup")
+
+
+def decode(table: ib.Table, column: str, lookup: ib.Table) -> ib.Table:
+    """Add back the string column of the code column 'column' (e.g. 'section_id' -> 'section') from a lookup table.
+    Meant for the visualisation end, once the data is aggregated.
+    """
+    code, value = lookup.columns[0], lookup.columns[1]
+    lookup = lookup.rename({f"{column}_lookup" : code, column.removesuffix("_id") : value})
+
+    return table.left_join(lookup, table[column] == lookup[f"{column}_lookup"]).drop(f"{column}_lookup")
+
+
+if __name__ == "__main__":
+    if "--refresh" in sys.argv:
+        for name in sources.keys():
+            print(name, fetch_source(name))
+    else:
+        print(json.dumps(load_manifest(), indent=2))